@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+"""Compare LSH candidate retrieval with the inverted index, for a grid of
+band and row counts.
+
+Clusters are built from the first part of a synthetic corpus with the
+inverted index. The held-out lines are then matched against those clusters
+both ways. recall is the fraction of lines where LSH finds the cluster that
+the index would assign, and candidate_recall the fraction of index
+candidates that LSH also finds. End-to-end throughput comes from clustering
+the whole corpus with each retrieval. Results are written as one JSON
+object per line.
+
+usage:
+    bench_lsh.py [--help --lines <N> --seed <S> --bands <B> --rows <R> --train <F> --output <FILE>]
+
+Options
+    -h, --help
+    -n, --lines <N>         Lines in the synthetic corpus [default: 20000]
+    -s, --seed <S>          Seed for the synthetic corpus [default: 0]
+    -b, --bands <B>         Comma-separated values of --lsh-bands [default: 8,16,32]
+    -r, --rows <R>          Comma-separated values of --lsh-rows [default: 1,2,3]
+    -f, --train <F>         Fraction of lines used to build clusters before matching the rest [default: .8]
+    -o, --output <FILE>     Write results to FILE instead of stdout.
+"""
+from collections import Counter
+from docopt import docopt
+from itertools import product
+import json
+import sys
+import time
+
+from sclust import sclust as sc
+from sclust.lsh import LSHScorer
+
+from synthetic import generate
+
+
+def throughput(corpus, **kwargs):
+    clusterer = sc.Clusterer(**kwargs)
+    start = time.perf_counter()
+    for line in corpus:
+        clusterer.assign(line)
+    return len(corpus) / (time.perf_counter() - start)
+
+
+def held_out(clusterer, lines, term_filter=5):
+    """ Return (tokens, idfs, top words) for each of lines with tokens. """
+    queries = []
+    for line in lines:
+        tokens = Counter(clusterer.vocab.intern(sc.tokenize(line)))
+        if len(tokens) > 0:
+            idfs = {t: sc.idf(t, clusterer.doc_freqs, clusterer.docnum) if clusterer.doc_freqs[t] > 0 else 0.
+                    for t in tokens}
+            queries.append((tokens, idfs, sorted(tokens, key=lambda x: -idfs[x])[:term_filter]))
+    return queries
+
+
+def compare(clusterer, queries, bands, rows):
+    """ Match queries against the clusters of clusterer with the index and with LSH. """
+    lsh = LSHScorer(clusterer.scorer, bands, rows)
+    for c in clusterer.clusters:
+        lsh.index(c, c.terms)
+    start = time.perf_counter()
+    exact = [sc.search_index(clusterer.index, words, clusterer.min_match) for _, _, words in queries]
+    index_us = 1e6 * (time.perf_counter() - start) / len(queries)
+    start = time.perf_counter()
+    found = [lsh.candidates(tokens) for tokens, _, _ in queries]
+    lsh_us = 1e6 * (time.perf_counter() - start) / len(queries)
+    hits, assigned, shared = 0, 0, 0
+    for (tokens, idfs, _), cands, lsh_cands in zip(queries, exact, found):
+        best, _ = clusterer.scorer.best(cands, clusterer.scorer.score(cands, tokens, idfs), clusterer.threshold)
+        lsh_cands = set(lsh_cands)
+        if best is not None:
+            assigned += 1
+            hits += best in lsh_cands
+        shared += len(lsh_cands.intersection(cands))
+    return {
+        'recall': hits / max(1, assigned),
+        'candidate_recall': shared / max(1, sum(len(c) for c in exact)),
+        'index_candidates_per_line': sum(len(c) for c in exact) / len(queries),
+        'lsh_candidates_per_line': sum(len(c) for c in found) / len(queries),
+        'index_retrieve_us': index_us,
+        'lsh_retrieve_us': lsh_us,
+    }
+
+
+def main():
+    args = docopt(__doc__)
+    corpus_params = {'lines': int(args['--lines']), 'seed': int(args['--seed'])}
+    corpus = list(generate(corpus_params['lines'], seed=corpus_params['seed']))
+    ntrain = int(float(args['--train']) * len(corpus))
+    clusterer = sc.Clusterer()
+    for line in corpus[:ntrain]:
+        clusterer.assign(line)
+    queries = held_out(clusterer, corpus[ntrain:])
+    out = open(args['--output'], 'w') if args['--output'] else sys.stdout
+    index_lines_per_sec = throughput(corpus)
+    for bands, rows in product([int(b) for b in args['--bands'].split(',')],
+                               [int(r) for r in args['--rows'].split(',')]):
+        result = compare(clusterer, queries, bands, rows)
+        result.update({'benchmark': 'lsh', 'corpus': corpus_params, 'bands': bands, 'rows': rows,
+                       'index_lines_per_sec': index_lines_per_sec,
+                       'lsh_lines_per_sec': throughput(corpus, retrieval='lsh', lsh_bands=bands, lsh_rows=rows)})
+        out.write(json.dumps(result, sort_keys=True) + '\n')
+        out.flush()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+"""Benchmark sclust on a synthetic corpus over a grid of options.
+
+For every combination of options, this measures end-to-end throughput of
+sclust.run, per-line latency percentiles of Clusterer.assign, peak memory,
+and the time of search_index, scoring, Cluster.add and prune_clusters in
+isolation. Results are written as one JSON object per line.
+
+usage:
+    bench_sclust.py [--help --lines <N> --seed <S> --engine <E> --thresholds <T> --min-matches <M> --term-filters <K> --prune-frequencies <P> --output <FILE> --compare <FILE>]
+
+Options
+    -h, --help
+    -n, --lines <N>                 Lines in the synthetic corpus [default: 5000]
+    -s, --seed <S>                  Seed for the synthetic corpus [default: 0]
+    -e, --engine <E>                Scoring engine [default: dict]
+    -t, --thresholds <T>            Comma-separated values of --threshold [default: .1,.2,.4]
+    -m, --min-matches <M>           Comma-separated values of --min-match [default: 1,2,3]
+    -k, --term-filters <K>          Comma-separated values of --term-filter [default: 3,5,10]
+    -p, --prune-frequencies <P>     Comma-separated values of --prune-frequency [default: -1,1000]
+    -o, --output <FILE>             Write results to FILE instead of stdout.
+    -c, --compare <FILE>            Print the throughput of each configuration relative to an earlier results FILE.
+"""
+from collections import Counter
+from docopt import docopt
+from itertools import product
+import io
+import json
+import multiprocessing
+import platform
+import random
+import resource
+import sys
+import time
+
+import sclust
+from sclust import sclust as sc
+
+from synthetic import generate
+
+
+class NullOutput:
+    def write(self, s):
+        pass
+
+    def flush(self):
+        pass
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p / 100. * len(values)))]
+
+
+def rss_mb():
+    """ Current resident set size, if /proc is available. """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * resource.getpagesize() / 1e6
+    except (IOError, OSError):
+        return 0.
+
+
+def time_calls(f, args):
+    """ Return the mean time in microseconds of f(*a) over args. """
+    if len(args) == 0:
+        return None
+    start = time.perf_counter()
+    for a in args:
+        f(*a)
+    return 1e6 * (time.perf_counter() - start) / len(args)
+
+
+def throughput(corpus, config):
+    stdin, stdout = sys.stdin, sys.stdout
+    sys.stdin = io.StringIO('\n'.join(corpus) + '\n')
+    sys.stdout = NullOutput()
+    try:
+        start = time.perf_counter()
+        sc.run(config['threshold'], config['prune_freq'], config['min_match'], config['term_filter'],
+               engine=config['engine'], flush='eof')
+        return len(corpus) / (time.perf_counter() - start)
+    finally:
+        sys.stdin, sys.stdout = stdin, stdout
+
+
+def components(clusterer, corpus, config, nsample=1000):
+    """ Time the stages of clustering in isolation against the final state of clusterer. """
+    rng = random.Random(0)
+    sample = [Counter(clusterer.vocab.intern(sc.tokenize(line))) for line in rng.sample(corpus, min(nsample, len(corpus)))]
+    sample = [tokens for tokens in sample if len(tokens) > 0]
+    queries = []
+    for tokens in sample:
+        idfs = {t: sc.idf(t, clusterer.doc_freqs, clusterer.docnum) for t in tokens}
+        words = sorted(tokens, key=lambda x: -idfs[x])[:config['term_filter']]
+        queries.append((tokens, idfs, words))
+    index, scorer, clusters = clusterer.index, clusterer.scorer, clusterer.clusters
+    candidates = [sc.search_index(index, words, config['min_match']) for _, _, words in queries]
+    ncandidates = sum(len(c) for c in candidates)
+    result = {
+        'search_index_us': time_calls(sc.search_index, [(index, words, config['min_match'])
+                                                        for _, _, words in queries]),
+        'score_us_per_line': time_calls(scorer.score, [(c, tokens, idfs) for c, (tokens, idfs, _)
+                                                       in zip(candidates, queries)]),
+        'candidates_per_line': ncandidates / max(1, len(queries)),
+    }
+    if len(clusters) > 0:
+        result['add_us'] = time_calls(scorer.add, [(rng.choice(clusters), tokens) for tokens in sample])
+        start = time.perf_counter()
+        sc.prune_clusters(clusters, index, n=3, scorer=scorer)
+        result['prune_clusters_ms'] = 1e3 * (time.perf_counter() - start)
+    return result
+
+
+def measure(corpus, config):
+    """ Run every measurement for one configuration. Meant to run in a fresh process. """
+    start_rss = rss_mb()
+    result = {'lines_per_sec': throughput(corpus, config)}
+    clusterer = sc.Clusterer(config['threshold'], config['prune_freq'], config['min_match'],
+                             config['term_filter'], config['engine'])
+    latencies = []
+    for line in corpus:
+        start = time.perf_counter()
+        clusterer.assign(line)
+        latencies.append(1e3 * (time.perf_counter() - start))
+    result['latency_ms'] = {'p50': percentile(latencies, 50), 'p90': percentile(latencies, 90),
+                            'p99': percentile(latencies, 99), 'max': max(latencies)}
+    result['clusters'] = len(clusterer.clusters)
+    result['postings'] = clusterer.stats()['postings']
+    result['peak_rss_mb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1e3
+    result['rss_growth_mb'] = result['peak_rss_mb'] - start_rss
+    result['components'] = components(clusterer, corpus, config)
+    return result
+
+
+def _measure(args):
+    return measure(*args)
+
+
+def main():
+    args = docopt(__doc__)
+    corpus_params = {'lines': int(args['--lines']), 'seed': int(args['--seed'])}
+    corpus = list(generate(corpus_params['lines'], seed=corpus_params['seed']))
+    grid = product([float(t) for t in args['--thresholds'].split(',')],
+                   [int(m) for m in args['--min-matches'].split(',')],
+                   [int(k) for k in args['--term-filters'].split(',')],
+                   [float(p) for p in args['--prune-frequencies'].split(',')])
+    baseline = {}
+    if args['--compare']:
+        with open(args['--compare']) as f:
+            for line in f:
+                r = json.loads(line)
+                baseline[json.dumps(r['config'], sort_keys=True)] = r
+    out = open(args['--output'], 'w') if args['--output'] else sys.stdout
+    for threshold, min_match, term_filter, prune_freq in grid:
+        config = {'threshold': threshold, 'min_match': min_match, 'term_filter': term_filter,
+                  'prune_freq': prune_freq, 'engine': args['--engine']}
+        # A fresh process per configuration, so peak memory is not shared.
+        with multiprocessing.Pool(1) as pool:
+            result = pool.map(_measure, [(corpus, config)])[0]
+        result.update({'benchmark': 'sclust', 'version': sclust.__version__,
+                       'python': platform.python_version(), 'corpus': corpus_params, 'config': config})
+        out.write(json.dumps(result, sort_keys=True) + '\n')
+        out.flush()
+        old = baseline.get(json.dumps(config, sort_keys=True))
+        if old:
+            sys.stderr.write('%s\t%.2fx lines/sec\n' % (json.dumps(config, sort_keys=True),
+                                                          result['lines_per_sec'] / old['lines_per_sec']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+"""Micro-benchmarks of turning lines into token id counts, the first stage
+of Clusterer.assign_batch.
+
+Each path is timed on the same lines, with a fresh Vocabulary, and the best
+of several repeats is reported:
+    findall        Counter(vocab.intern(re.findall(...))) per line, as
+                   sclust did before sclust.tokenizer
+    tokenize       Counter(vocab.intern(tokenizer(line))) per line
+    count          vocab.count(tokenizer(line)) per line
+    tokenize_many  vocab.count of each line of tokenizer.tokenize_many,
+                   batch_size lines at a time
+
+Each tokenizer configuration (default, normalizers, stopwords, both) is
+timed with each path but findall. Results are written as one JSON object per
+line.
+
+usage:
+    bench_tokenize.py [--help --lines <N> --seed <S> --input <FILE> --batch-size <B> --repeat <R> --output <FILE>]
+
+Options
+    -h, --help
+    -n, --lines <N>         Lines in the synthetic corpus [default: 50000]
+    -s, --seed <S>          Seed for the synthetic corpus [default: 0]
+    -i, --input <FILE>      Time the lines of FILE instead of a synthetic corpus.
+    -b, --batch-size <B>    Lines per call of tokenize_many [default: 64]
+    -r, --repeat <R>        Report the best of R timings [default: 5]
+    -o, --output <FILE>     Write results to FILE instead of stdout.
+"""
+from collections import Counter
+from docopt import docopt
+from itertools import islice
+import json
+import re
+import sys
+import time
+
+from sclust import sclust as sc
+from sclust.tokenizer import NORMALIZERS, Tokenizer
+
+from synthetic import generate
+
+
+def findall(corpus, vocab, tokenizer, batch_size):
+    return [Counter(vocab.intern(re.findall(r'\w+', line.lower()))) for line in corpus]
+
+
+def tokenize(corpus, vocab, tokenizer, batch_size):
+    return [Counter(vocab.intern(tokenizer(line))) for line in corpus]
+
+
+def count(corpus, vocab, tokenizer, batch_size):
+    return [vocab.count(tokenizer(line)) for line in corpus]
+
+
+def tokenize_many(corpus, vocab, tokenizer, batch_size):
+    lines = iter(corpus)
+    counts = []
+    while True:
+        batch = list(islice(lines, batch_size))
+        if len(batch) == 0:
+            return counts
+        counts.extend(vocab.count(tokens) for tokens in tokenizer.tokenize_many(batch))
+
+
+def best_time(path, corpus, tokenizer, batch_size, repeat):
+    best = None
+    for _ in range(repeat):
+        vocab = sc.Vocabulary()
+        start = time.perf_counter()
+        path(corpus, vocab, tokenizer, batch_size)
+        seconds = time.perf_counter() - start
+        best = seconds if best is None else min(best, seconds)
+    return best
+
+
+def main():
+    args = docopt(__doc__)
+    if args['--input']:
+        with open(args['--input']) as f:
+            corpus = [line.strip() for line in f]
+        corpus_params = {'input': args['--input']}
+    else:
+        corpus_params = {'lines': int(args['--lines']), 'seed': int(args['--seed'])}
+        corpus = list(generate(corpus_params['lines'], seed=corpus_params['seed']))
+    batch_size, repeat = int(args['--batch-size']), int(args['--repeat'])
+    out = open(args['--output'], 'w') if args['--output'] else sys.stdout
+    configs = [('default', Tokenizer()),
+               ('normalizers', Tokenizer(normalizers=list(NORMALIZERS))),
+               ('stopwords', Tokenizer(stopwords='english')),
+               ('normalizers+stopwords', Tokenizer(normalizers=list(NORMALIZERS), stopwords='english'))]
+    runs = [('findall', 'default', Tokenizer())]
+    runs += [(path, name, tokenizer) for name, tokenizer in configs
+             for path in ['tokenize', 'count', 'tokenize_many']]
+    paths = {'findall': findall, 'tokenize': tokenize, 'count': count, 'tokenize_many': tokenize_many}
+    for path, name, tokenizer in runs:
+        seconds = best_time(paths[path], corpus, tokenizer, batch_size, repeat)
+        result = {'benchmark': 'tokenize', 'corpus': corpus_params, 'path': path, 'tokenizer': name,
+                  'batch_size': batch_size, 'lines_per_sec': len(corpus) / seconds,
+                  'usec_per_line': 1e6 * seconds / len(corpus)}
+        out.write(json.dumps(result, sort_keys=True) + '\n')
+        out.flush()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+"""Measure what --max-terms saves in memory and time, and what it costs in
+clustering quality, on a synthetic corpus.
+
+For each value of max_terms, the corpus is clustered with a Clusterer, and
+the report gives throughput, index size, estimated memory, mean candidates
+per line, the adjusted Rand index of the assignments against those of the
+untruncated run (1 means the same clustering), and the purity of clusters
+with respect to the topics the corpus was generated from. Results are
+written as one JSON object per line.
+
+usage:
+    bench_truncation.py [--help --lines <N> --seed <S> --engine <E> --max-terms <M> --output <FILE>]
+
+Options
+    -h, --help
+    -n, --lines <N>         Lines in the synthetic corpus [default: 20000]
+    -s, --seed <S>          Seed for the synthetic corpus [default: 0]
+    -e, --engine <E>        Scoring engine [default: dict]
+    -m, --max-terms <M>     Comma-separated values of --max-terms [default: 3,5,8,12]
+    -o, --output <FILE>     Write results to FILE instead of stdout.
+"""
+from collections import Counter
+from docopt import docopt
+import json
+import sys
+import time
+
+from sclust import sclust as sc
+
+from synthetic import generate
+
+
+def pairs(n):
+    return n * (n - 1) / 2.
+
+
+def adjusted_rand_index(labels, other):
+    """
+    Return the adjusted Rand index of two clusterings given as lists of labels.
+
+    >>> adjusted_rand_index([0, 0, 1, 1], [5, 5, 3, 3])
+    1.0
+    """
+    n = len(labels)
+    both = sum(pairs(v) for v in Counter(zip(labels, other)).values())
+    first = sum(pairs(v) for v in Counter(labels).values())
+    second = sum(pairs(v) for v in Counter(other).values())
+    expected = first * second / pairs(n)
+    top = (first + second) / 2.
+    return (both - expected) / (top - expected) if top != expected else 1.
+
+
+def purity(labels, topics):
+    """
+    Return the fraction of lines whose cluster's most common topic is their own.
+
+    >>> purity([0, 0, 0, 1], ['a', 'a', 'b', 'b'])
+    0.75
+    """
+    counts = Counter(zip(labels, topics))
+    best = {}
+    for (label, _), v in counts.items():
+        best[label] = max(best.get(label, 0), v)
+    return sum(best.values()) / float(len(labels))
+
+
+def cluster(corpus, engine, max_terms):
+    clusterer = sc.Clusterer(engine=engine, max_terms=max_terms)
+    start = time.perf_counter()
+    labels = [r[0] if r is not None else -1 for r in clusterer.assign_many(corpus)]
+    seconds = time.perf_counter() - start
+    stats = clusterer.stats()
+    return labels, {
+        'lines_per_sec': len(corpus) / seconds,
+        'clusters': stats['clusters'],
+        'postings': stats['postings'],
+        'index_terms': stats['index_terms'],
+        'memory_mb': sc.memory_usage(clusterer.clusters, clusterer.doc_freqs) / 1e6,
+        'mean_candidates': clusterer.counters['candidates'] / max(1, clusterer.counters['docs']),
+        'centroid_terms': sum(len(c.term_weights) for c in clusterer.clusters),
+    }
+
+
+def main():
+    args = docopt(__doc__)
+    corpus_params = {'lines': int(args['--lines']), 'seed': int(args['--seed'])}
+    corpus, topics = zip(*generate(corpus_params['lines'], seed=corpus_params['seed'], with_topics=True))
+    out = open(args['--output'], 'w') if args['--output'] else sys.stdout
+    baseline, _ = cluster(corpus, args['--engine'], -1)
+    for max_terms in [-1] + [int(m) for m in args['--max-terms'].split(',')]:
+        labels, result = cluster(corpus, args['--engine'], max_terms)
+        result.update({'benchmark': 'truncation', 'corpus': corpus_params, 'engine': args['--engine'],
+                       'max_terms': max_terms, 'adjusted_rand_index': adjusted_rand_index(baseline, labels),
+                       'topic_purity': purity(labels, topics)})
+        out.write(json.dumps(result, sort_keys=True) + '\n')
+        out.flush()
+
+
+if __name__ == '__main__':
+    main()
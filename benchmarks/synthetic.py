@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+"""Generate a reproducible, tweet-like synthetic corpus for benchmarking sclust.
+
+usage:
+    synthetic.py [--help --lines <N> --vocab-size <V> --topics <T> --zipf <Z> --duplicates <D> --near-duplicates <R> --burst-length <B> --seed <S>]
+
+Options
+    -h, --help
+    -n, --lines <N>             Number of lines to generate [default: 10000]
+    -v, --vocab-size <V>        Number of distinct background words [default: 20000]
+    -t, --topics <T>            Number of topics [default: 200]
+    -z, --zipf <Z>              Zipf exponent of the background word distribution [default: 1.1]
+    -d, --duplicates <D>        Fraction of lines that repeat a recent line verbatim (like retweets) [default: .1]
+    -r, --near-duplicates <R>   Fraction of lines that repeat a recent line with one word changed [default: .1]
+    -b, --burst-length <B>      Average number of lines a topic stays hot [default: 500]
+    -s, --seed <S>              Random seed [default: 0]
+"""
+from docopt import docopt
+from itertools import accumulate
+import random
+
+SYLLABLES = [c + v for c in 'bdfghjklmnprstvwz' for v in 'aeiou']
+FILLERS = ['rt', 'lol', 'webaddress', 'happyemoticon', 'exclamationpoint']
+
+
+def word(rank):
+    """ A pronounceable word for a rank; frequent words are short. """
+    syllables = []
+    rank += 1
+    while rank > 0:
+        rank, r = divmod(rank - 1, len(SYLLABLES))
+        syllables.append(SYLLABLES[r])
+    return ''.join(syllables)
+
+
+def generate(num_lines, vocab_size=20000, num_topics=200, zipf=1.1, duplicates=.1,
+             near_duplicates=.1, burst_length=500, seed=0, with_topics=False):
+    """
+    Yield num_lines tweet-like lines. Each line mixes words from a few hot
+    topics with Zipf-distributed background words. Topics come and go in
+    bursts, and some lines are verbatim or near repeats of recent lines.
+    With with_topics, yield (line, topic) pairs instead, where a repeat has
+    the topic of the line it repeats.
+
+    >>> list(generate(3, seed=1)) == list(generate(3, seed=1))
+    True
+    """
+    rng = random.Random(seed)
+    vocab = [word(r) for r in range(vocab_size)]
+    cum_weights = list(accumulate(1. / (r + 1) ** zipf for r in range(vocab_size)))
+    topics = [['%s%d' % (word(rng.randrange(vocab_size)), t) for _ in range(rng.randint(4, 12))]
+              for t in range(num_topics)]
+    hot = [rng.randrange(num_topics) for _ in range(5)]
+    recent = []
+    for _ in range(num_lines):
+        if rng.random() < 5. / burst_length:
+            hot[rng.randrange(len(hot))] = rng.randrange(num_topics)
+        r = rng.random()
+        if recent and r < duplicates:
+            line, t = rng.choice(recent)
+        elif recent and r < duplicates + near_duplicates:
+            line, t = rng.choice(recent)
+            words = line.split()
+            words[rng.randrange(len(words))] = rng.choices(vocab, cum_weights=cum_weights)[0]
+            line = ' '.join(words)
+        else:
+            t = rng.choice(hot)
+            topic = topics[t]
+            words = rng.sample(topic, rng.randint(2, min(5, len(topic))))
+            words += rng.choices(vocab, cum_weights=cum_weights, k=rng.randint(1, 12))
+            if rng.random() < .3:
+                words.append(rng.choice(FILLERS))
+            rng.shuffle(words)
+            line = ' '.join(words)
+        recent.append((line, t))
+        if len(recent) > 100:
+            recent.pop(0)
+        yield (line, t) if with_topics else line
+
+
+def main():
+    args = docopt(__doc__)
+    for line in generate(int(args['--lines']), int(args['--vocab-size']), int(args['--topics']),
+                         float(args['--zipf']), float(args['--duplicates']),
+                         float(args['--near-duplicates']), int(args['--burst-length']),
+                         int(args['--seed'])):
+        print(line)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+"""Term statistics of constant size, with the hashing trick.
+
+Tokens are hashed into a fixed number of buckets, and the bucket is the term
+id, so no token strings are kept. Document frequencies live in a
+preallocated array indexed by bucket. Distinct tokens that hash to the same
+bucket share one id and one count.
+
+With a half-life, the counts a line adds, and the line itself in the line
+count that idf uses, halve every half_life lines, so idfs follow the recent
+stream rather than all of history.
+"""
+from array import array
+from collections import Counter
+from math import log10
+import numpy as np
+import zlib
+
+# Rescale the stored counts once a line would add more than 2 ** RESCALE.
+RESCALE = 64
+
+
+class HashedVocabulary:
+    """
+    A Vocabulary whose ids are buckets of a hash of each token.
+
+    >>> v = HashedVocabulary(1 << 20)
+    >>> v.intern(['cat', 'dog', 'cat'])
+    [934824, 801149, 934824]
+    """
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.tokens = []
+
+    def __len__(self):
+        return self.buckets
+
+    def intern(self, tokens):
+        buckets = self.buckets
+        return [zlib.crc32(t.encode('utf-8')) % buckets for t in tokens]
+
+    lookup = intern
+
+    def count(self, tokens):
+        """ Return a Counter of the ids of tokens. """
+        buckets, crc32 = self.buckets, zlib.crc32
+        counts = Counter.__new__(Counter)
+        get = counts.get
+        for t in tokens:
+            i = crc32(t.encode('utf-8')) % buckets
+            counts[i] = get(i, 0) + 1
+        return counts
+
+    def forget(self, ids):
+        pass
+
+
+class BucketCounts:
+    """
+    Document frequencies of term ids in [0, buckets), optionally decayed.
+
+    With a half-life, the counts added at line n are stored multiplied by
+    2 ** (n / half_life), and divided by the same factor for the current
+    line when read, so decaying all counts takes no work.
+
+    Counts are stored in an array, which is cheap to index one element at a
+    time, and viewed as a numpy array for whole-array work. A second array
+    holds the log10 of each count, refreshed lazily for the buckets updated
+    since it was last read, so idfs are read by index with no log per token.
+
+    >>> d = BucketCounts(8, half_life=2)
+    >>> d.update({1: 1, 2: 3}, 1)
+    >>> d.update({1: 1}, 3)
+    >>> d.count(1, 3), d.count(2, 3)
+    (1.5, 1.5)
+    >>> round(d.lines(3), 3)
+    2.207
+    >>> table, top, floor = d.idf_table(3)
+    >>> [round(top - max(table[t], floor), 2) for t in (1, 2, 3)]
+    [0.33, 0.33, 0.51]
+    """
+    def __init__(self, buckets, half_life=-1):
+        self.data = array('d', bytes(8 * buckets))
+        self.counts = np.frombuffer(self.data)
+        self.half_life = half_life
+        # The line at which stored counts are unscaled.
+        self.origin = 0
+        # log10 of each stored count of at least 1, else 0, except for the
+        # buckets in dirty.
+        self.table_data = array('d', bytes(8 * buckets))
+        self.table = np.frombuffer(self.table_data)
+        self.dirty = set()
+
+    def __len__(self):
+        return len(self.counts)
+
+    @property
+    def nbytes(self):
+        return self.counts.nbytes + self.table.nbytes
+
+    def scale(self, docnum):
+        """ The factor that counts added at line docnum are stored multiplied by. """
+        if self.half_life <= 0:
+            return 1.
+        return 2. ** ((docnum - self.origin) / self.half_life)
+
+    def lines(self, docnum):
+        """ The number of lines up to docnum, decayed like the counts. """
+        if self.half_life <= 0:
+            return float(docnum)
+        decay = 2. ** (-1. / self.half_life)
+        return (1. - decay ** docnum) / (1. - decay)
+
+    def count(self, t, docnum):
+        return self.data[t] / self.scale(docnum)
+
+    def update(self, tokens, docnum):
+        """ Add the counts of tokens, a dict of term ids to counts, at line docnum. """
+        scale = self.scale(docnum)
+        if scale > 2. ** RESCALE:
+            self.counts /= scale
+            self.origin = docnum
+            self.rebuild()
+            scale = 1.
+        data = self.data
+        for t, v in tokens.items():
+            data[t] += v * scale
+        self.dirty.update(tokens)
+
+    def rebuild(self):
+        """ Recompute the whole log table, after the counts were set directly. """
+        self.table[:] = np.log10(np.maximum(self.counts, 1.))
+        self.dirty.clear()
+
+    def idf_table(self, docnum):
+        """ Return (table, top, floor) for line docnum: the idf of bucket t is
+        top - max(table[t], floor). Empty buckets get the idf of a term seen
+        once. """
+        data, table, dirty = self.data, self.table_data, self.dirty
+        for t in dirty:
+            v = data[t]
+            table[t] = log10(v) if v > 1. else 0.
+        dirty.clear()
+        scale = self.scale(docnum)
+        return table, log10((self.lines(docnum) + 1) * scale), log10(scale)
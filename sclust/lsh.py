@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+"""Candidate retrieval with MinHash signatures kept in banded hash tables,
+as an alternative to the inverted index.
+
+A cluster's signature is the MinHash of every token assigned to it, so
+adding a line takes the elementwise minimum of the two signatures. The
+signature is cut into bands of rows values each. A cluster is a candidate
+for a line if any band of their signatures is equal. A line and a cluster
+whose token sets have Jaccard similarity s are matched with probability
+1 - (1 - s ** rows) ** bands, so the lookup cost per line is a fixed number
+of hash table probes.
+"""
+import numpy as np
+
+PRIME = (1 << 31) - 1
+
+
+class LSHScorer:
+    """
+    Wrap a scoring engine, keeping each of its clusters in banded MinHash
+    tables. Removing clusters from the engine also removes them from the
+    tables. Everything else is passed through to the engine.
+
+    >>> from .sclust import DictScorer
+    >>> lsh = LSHScorer(DictScorer(), bands=8, rows=2)
+    >>> c = lsh.new_cluster(0, {1: 1, 2: 1, 3: 1})
+    >>> lsh.candidates({1: 2, 2: 1, 3: 1}) == [c]
+    True
+    >>> lsh.candidates({4: 1, 5: 1})
+    []
+    >>> lsh.remove([c])
+    >>> lsh.candidates({1: 1, 2: 1, 3: 1})
+    []
+    """
+    def __init__(self, scorer, bands=32, rows=2, seed=0):
+        rng = np.random.RandomState(seed)
+        self.scorer = scorer
+        self.bands = bands
+        self.rows = rows
+        # One universal hash (a * x + b) % PRIME per signature value.
+        self.a = rng.randint(1, PRIME, size=bands * rows).astype(np.int64)
+        self.b = rng.randint(0, PRIME, size=bands * rows).astype(np.int64)
+        self.tables = [{} for _ in range(bands)]
+        self.signatures = {}
+
+    def __getattr__(self, name):
+        return getattr(self.scorer, name)
+
+    def signature(self, tokens):
+        """ Return the MinHash signature of a collection of term ids. """
+        ids = np.fromiter(tokens, dtype=np.int64, count=len(tokens))
+        return ((np.outer(ids, self.a) + self.b) % PRIME).min(axis=0)
+
+    def keys(self, signature):
+        """ Return the hash table key of each band of signature. """
+        data = signature.tobytes()
+        step = len(data) // self.bands
+        return [data[i:i + step] for i in range(0, len(data), step)]
+
+    def candidates(self, tokens):
+        """ Return the clusters sharing at least one band with tokens. """
+        found = {}
+        for table, key in zip(self.tables, self.keys(self.signature(tokens))):
+            bucket = table.get(key)
+            if bucket:
+                found.update(dict.fromkeys(bucket))
+        return list(found)
+
+    def index(self, cluster, tokens):
+        """ Add tokens to the signature of cluster, moving it to the buckets of
+        any band that changed. """
+        if len(tokens) == 0:
+            return
+        self.fold(cluster, self.signature(tokens))
+
+    def fold(self, cluster, signature):
+        """ Take the elementwise minimum of signature and the signature of
+        cluster, moving the cluster to the buckets of any band that changed. """
+        old = self.signatures.get(cluster)
+        if old is None:
+            old_keys = [None] * self.bands
+        else:
+            signature = np.minimum(old, signature)
+            old_keys = self.keys(old)
+        self.signatures[cluster] = signature
+        for table, old_key, key in zip(self.tables, old_keys, self.keys(signature)):
+            if key == old_key:
+                continue
+            if old_key is not None:
+                self._discard(table, old_key, cluster)
+            table.setdefault(key, set()).add(cluster)
+
+    def _discard(self, table, key, cluster):
+        bucket = table[key]
+        bucket.discard(cluster)
+        if len(bucket) == 0:
+            del table[key]
+
+    def new_cluster(self, _id, tokens):
+        cluster = self.scorer.new_cluster(_id, tokens)
+        self.index(cluster, tokens)
+        return cluster
+
+    def restore(self, _id, size, total_tokens, term_weights):
+        cluster = self.scorer.restore(_id, size, total_tokens, term_weights)
+        self.index(cluster, term_weights)
+        return cluster
+
+    def add(self, cluster, tokens):
+        self.scorer.add(cluster, tokens)
+        self.index(cluster, tokens)
+
+    def merge(self, cluster, other):
+        self.scorer.merge(cluster, other)
+        signature = self.signatures.get(other)
+        if signature is not None:
+            self.fold(cluster, signature)
+
+    def remove(self, clusters):
+        for c in clusters:
+            signature = self.signatures.pop(c, None)
+            if signature is not None:
+                for table, key in zip(self.tables, self.keys(signature)):
+                    self._discard(table, key, c)
+        self.scorer.remove(clusters)
@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -*-
+"""A NumPy scoring engine that stores cluster centroids in a growable sparse
+term-by-cluster matrix, so that all candidate clusters for a line are scored
+at once.
+
+Each cluster is one row of a CSR matrix over integer term ids. A cluster's
+terms are fixed when it is created (Cluster.add only reweights existing
+terms), so rows never change shape. We store the raw token mass of each term
+(term_score * total_tokens) rather than the normalized score, which means
+adding a line only touches the entries for that line's tokens.
+"""
+from array import array
+import numpy as np
+
+
+def _grow(arr, n):
+    """ Return arr, or a copy of it with at least n slots. """
+    if n <= len(arr):
+        return arr
+    new = np.zeros(max(n, 2 * len(arr)), dtype=arr.dtype)
+    new[:len(arr)] = arr
+    return new
+
+
+class MatrixCluster:
+    """ A cluster whose centroid lives in a row of a MatrixScorer. """
+    __slots__ = ('_id', 'row', 'size', 'scorer', 'terms', 'created', 'updated')
+
+    def __init__(self, _id, row, scorer):
+        self._id = _id
+        self.row = row
+        self.size = 1
+        self.terms = array('l')  # terms this cluster is indexed under
+        self.created = 0  # line number that created this cluster
+        self.updated = 0  # line number last assigned to this cluster
+        self.scorer = scorer
+
+    def __hash__(self):
+        return self._id
+
+    @property
+    def total_tokens(self):
+        return float(self.scorer.totals[self.row])
+
+    @property
+    def term_scores(self):
+        return {t: w / self.total_tokens for t, w in self.term_weights.items()}
+
+    @property
+    def term_weights(self):
+        return self.scorer.term_weights(self)
+
+
+class MatrixScorer:
+    """
+    >>> m = MatrixScorer()
+    >>> c = m.new_cluster(0, {1: 2, 2: 1})
+    >>> c.term_scores[1]  # doctest: +ELLIPSIS
+    0.666...
+    >>> m.score([c], {1: 10}, {1: .5})  # doctest: +ELLIPSIS
+    array([3.333...])
+    >>> [list(s) for s in m.score_many([([c], {1: 1}), ([], {2: 1})], {1: .5, 2: 1})]  # doctest: +ELLIPSIS
+    [[np.float64(0.333...)], []]
+    >>> m.add(c, {1: 3, 2: 4})
+    >>> c.term_scores[1]
+    0.5
+    >>> c.term_scores[2]
+    0.5
+    >>> m.merge(c, m.new_cluster(1, {2: 1, 3: 1}))
+    >>> c.size, c.term_scores[2]
+    (3, 0.5)
+    """
+    def __init__(self, capacity=1024):
+        self.nterms = 0
+        self.nrows = 0
+        self.nnz = 0
+        self.dead = set()
+        self.indptr = np.zeros(capacity + 1, dtype=np.int64)
+        self.totals = np.zeros(capacity, dtype=np.float64)
+        self.indices = np.zeros(8 * capacity, dtype=np.int64)
+        self.data = np.zeros(8 * capacity, dtype=np.float64)
+        self.clusters = []
+        self._cache = {}
+
+    def term_ids(self, tokens):
+        """ Return sorted term ids for tokens, and the matching token counts.
+        Results are cached for the lines of the current batch, since run
+        scores and then adds the same token counts. """
+        cached = self._cache.get(id(tokens))
+        if cached is not None and cached[0] is tokens:
+            return cached[1], cached[2]
+        if len(self._cache) >= 4096:
+            self._cache = {}
+        ids = np.fromiter(tokens.keys(), dtype=np.int64, count=len(tokens))
+        counts = np.fromiter(tokens.values(), dtype=np.float64, count=len(tokens))
+        if len(ids) > 0:
+            self.nterms = max(self.nterms, ids.max() + 1)
+        order = np.argsort(ids)
+        self._cache[id(tokens)] = (tokens, ids[order], counts[order])
+        return ids[order], counts[order]
+
+    def new_cluster(self, _id, tokens):
+        ids, counts = self.term_ids(tokens)
+        row = self.nrows
+        start, end = self.nnz, self.nnz + len(ids)
+        self.indptr = _grow(self.indptr, row + 2)
+        self.totals = _grow(self.totals, row + 1)
+        self.indices = _grow(self.indices, end)
+        self.data = _grow(self.data, end)
+        self.indices[start:end] = ids
+        self.data[start:end] = counts
+        self.indptr[row + 1] = end
+        self.totals[row] = counts.sum()
+        self.nrows += 1
+        self.nnz = end
+        cluster = MatrixCluster(_id, row, self)
+        self.clusters.append(cluster)
+        return cluster
+
+    def restore(self, _id, size, total_tokens, term_weights):
+        cluster = self.new_cluster(_id, term_weights)
+        cluster.size = size
+        self.totals[cluster.row] = total_tokens
+        return cluster
+
+    def add(self, cluster, tokens):
+        ids, counts = self.term_ids(tokens)
+        self._accumulate(cluster.row, ids, counts)
+        self.totals[cluster.row] += counts.sum()
+        cluster.size += 1
+
+    def _accumulate(self, row, ids, counts):
+        """ Add counts to the entries of row for the terms ids (sorted) it has. """
+        start, end = self.indptr[row], self.indptr[row + 1]
+        row_ids = self.indices[start:end]
+        pos = np.searchsorted(row_ids, ids)
+        pos[pos == len(row_ids)] = 0
+        hit = row_ids[pos] == ids
+        self.data[start + pos[hit]] += counts[hit]
+
+    def merge(self, cluster, other):
+        """ Absorb the lines of cluster other into cluster, as if they had
+        been added to it. """
+        start, end = self.indptr[other.row], self.indptr[other.row + 1]
+        self._accumulate(cluster.row, self.indices[start:end], self.data[start:end])
+        self.totals[cluster.row] += self.totals[other.row]
+        cluster.size += other.size
+
+    def score(self, clusters, tokens, idfs):
+        """ Return an array with the score of each cluster for this line. """
+        return self.score_many([(clusters, tokens)], idfs)[0]
+
+    def score_many(self, queries, idfs):
+        """
+        Score a list of (clusters, tokens) queries in one pass, returning one
+        array of scores per query. Each (query, row term) pair is keyed by
+        query number * vocabulary size + term id, so a single sorted search
+        matches row entries against the terms of their own query.
+        """
+        if len(queries) == 0:
+            return []
+        qids, qweights, rows = [], [], []
+        for clusters, tokens in queries:
+            ids, counts = self.term_ids(tokens)
+            qids.append(ids)
+            qweights.append(counts * np.array([idfs[i] for i in ids.tolist()]))
+            rows.append(np.fromiter((c.row for c in clusters), dtype=np.int64, count=len(clusters)))
+        nterms = self.nterms
+        qkeys = np.concatenate([ids + j * nterms for j, ids in enumerate(qids)])
+        qweights = np.concatenate(qweights)
+        nrows = [len(r) for r in rows]
+        query = np.repeat(np.arange(len(rows)), nrows)
+        rows = np.concatenate(rows)
+        starts = self.indptr[rows]
+        lens = self.indptr[rows + 1] - starts
+        # Flat positions of every nonzero in every candidate row.
+        owner = np.repeat(np.arange(len(rows)), lens)
+        pos = np.arange(lens.sum()) + np.repeat(starts - np.cumsum(lens) + lens, lens)
+        keys = self.indices[pos] + query[owner] * nterms
+        qpos = np.searchsorted(qkeys, keys)
+        qpos[qpos == len(qkeys)] = 0
+        contrib = np.where(qkeys[qpos] == keys, self.data[pos] * qweights[qpos], 0.)
+        scores = np.bincount(owner, weights=contrib, minlength=len(rows)) / self.totals[rows]
+        return np.split(scores, np.cumsum(nrows)[:-1])
+
+    def best(self, clusters, scores, threshold):
+        """ Return the highest scoring cluster above threshold and its score,
+        or (None, -1). Ties go to the earliest cluster, as in the dict path. """
+        if len(scores) == 0:
+            return None, -1
+        i = np.argmax(scores)
+        if scores[i] > threshold:
+            return clusters[i], scores[i]
+        return None, -1
+
+    def term_weights(self, cluster):
+        start, end = self.indptr[cluster.row], self.indptr[cluster.row + 1]
+        return dict(zip(self.indices[start:end].tolist(), self.data[start:end].tolist()))
+
+    def remove(self, clusters):
+        """ Drop the rows of removed clusters, compacting once half are dead. """
+        self.dead.update(clusters)
+        if len(self.dead) * 2 < self.nrows:
+            return
+        live = [c for c in self.clusters if c not in self.dead]
+        rows = np.array([c.row for c in live], dtype=np.int64)
+        starts = self.indptr[rows]
+        lens = self.indptr[rows + 1] - starts
+        pos = np.arange(lens.sum()) + np.repeat(starts - np.cumsum(lens) + lens, lens)
+        self.indices[:len(pos)] = self.indices[pos]
+        self.data[:len(pos)] = self.data[pos]
+        self.totals[:len(rows)] = self.totals[rows]
+        self.indptr[1:len(rows) + 1] = np.cumsum(lens)
+        for row, c in enumerate(live):
+            c.row = row
+        self.clusters = live
+        self.nrows = len(live)
+        self.nnz = len(pos)
+        self.dead = set()
@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+"""Cluster a file in several passes, for corpora that are known in advance.
+
+1. Count the document frequency of every term over the whole file, one
+   process per chunk of the memory-mapped file. The counts can be saved as
+   an idf table (see state.save_idf_table) and reused by later runs on the
+   same file, unchanged in size, with the same tokenizer settings.
+2. Cluster the lines in order with idfs frozen at those global values, so
+   early lines are weighted the same as late ones.
+3. Optionally, reassign every line to the best of the final clusters, with
+   a pool of processes that each take chunks of the file. A line that no
+   final cluster scores above the threshold keeps its cluster from pass 2.
+
+Every pass splits lines on newlines and decodes them as UTF-8, so all
+passes see the same lines. The passes map the file into memory, so it cannot
+be compressed.
+"""
+from array import array
+from collections import Counter
+from itertools import islice
+import math
+import mmap
+import multiprocessing
+import os
+
+from . import state
+from .streams import MAGIC, compression
+
+# Files are split into chunks of about this many bytes, and at least one
+# chunk per worker.
+CHUNK_BYTES = 1 << 24
+
+
+def chunk_ranges(path, nchunks):
+    """
+    Split the file at path into at most nchunks (start, end) byte ranges,
+    each starting at the start of a line.
+    """
+    size = os.path.getsize(path)
+    if size == 0:
+        return []
+    bounds = [0]
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        for i in range(1, nchunks):
+            pos = mm.find(b'\n', max(bounds[-1], size * i // nchunks))
+            if pos == -1 or pos + 1 >= size:
+                break
+            bounds.append(pos + 1)
+    return list(zip(bounds, bounds[1:] + [size]))
+
+
+def read_lines(path, start, end):
+    """ Yield the stripped lines of the file at path that start in [start, end). """
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        mm.seek(start)
+        while mm.tell() < end:
+            yield mm.readline().decode('utf-8', 'replace').strip()
+
+
+def count_chunk(task):
+    """ Return (doc_freqs, number of lines) for the chunk (path, start, end,
+    tokenizer). """
+    path, start, end, tokenizer = task
+    doc_freqs = Counter()
+    nlines = 0
+    for line in read_lines(path, start, end):
+        doc_freqs.update(set(tokenizer(line)))
+        nlines += 1
+    return doc_freqs, nlines
+
+
+def idf_source(path, tokenizer):
+    """ Describe the document frequencies of the file at path split into
+    tokens by tokenizer, to check an idf table against. """
+    return {'path': os.path.abspath(path), 'size': os.path.getsize(path), 'tokenizer': tokenizer.config()}
+
+
+def document_frequencies(path, ranges, tokenizer, workers=1):
+    """ Return the document frequencies of terms over the chunks ranges of the
+    file at path, split into tokens by tokenizer, and the number of lines. """
+    doc_freqs = Counter()
+    nlines = 0
+    for freqs, n in parallel_map(count_chunk, [(path, s, e, tokenizer) for s, e in ranges], workers):
+        doc_freqs.update(freqs)
+        nlines += n
+    return doc_freqs, nlines
+
+
+# The clusterer that reassign_chunk uses, set in each process by set_clusterer.
+_clusterer = None
+
+
+def set_clusterer(clusterer):
+    global _clusterer
+    _clusterer = clusterer
+
+
+def reassign_chunk(task):
+    """ Return Clusterer.nearest for each line of the chunk (path, start, end). """
+    return [_clusterer.nearest(line) for line in read_lines(*task)]
+
+
+def parallel_map(func, tasks, workers=1, initializer=None, initargs=()):
+    """ Yield func(task) for each of tasks in order, with a pool of workers
+    processes if workers > 1. """
+    if workers <= 1:
+        if initializer is not None:
+            initializer(*initargs)
+        for task in tasks:
+            yield func(task)
+        return
+    with multiprocessing.Pool(workers, initializer, initargs) as pool:
+        for result in pool.imap(func, tasks):
+            yield result
+
+
+def run_offline(clusterer, path, sink, workers=1, batch_size=1, idf_table=None, reassign=False):
+    """
+    Cluster the lines of the file at path with clusterer, and write the
+    cluster id, line and score of each line to sink, as sclust.run does.
+
+    Document frequencies are read from idf_table if that file exists, and
+    otherwise counted with workers processes, then saved to idf_table if
+    given. A table counted from another file or with other tokenizer
+    settings is refused with a ValueError. With reassign, the output is the
+    assignment of each line to the final clusters, also computed with
+    workers processes.
+    """
+    with open(path, 'rb') as f:
+        module = compression(f.read(len(MAGIC[-1][0])))
+    if module is not None:
+        raise ValueError('%s is compressed (%s); decompress it to use --offline' % (path, module))
+    ranges = chunk_ranges(path, max(workers, os.path.getsize(path) // CHUNK_BYTES + 1))
+    source = idf_source(path, clusterer.tokenizer)
+    if idf_table and os.path.exists(idf_table):
+        doc_freqs, nlines = state.load_idf_table(idf_table, source)
+    else:
+        doc_freqs, nlines = document_frequencies(path, ranges, clusterer.tokenizer, workers)
+        if idf_table:
+            state.save_idf_table(idf_table, doc_freqs, nlines, source)
+    clusterer.freeze_idfs(doc_freqs, nlines)
+    # With reassign, the cluster id and score of every line from pass 2,
+    # -1 and NaN for lines without tokens or that started a cluster.
+    ids, scores = array('q'), array('d')
+    for start, end in ranges:
+        lines = read_lines(path, start, end)
+        while True:
+            batch = list(islice(lines, batch_size))
+            if len(batch) == 0:
+                break
+            for line, result in zip(batch, clusterer.assign_batch(batch)):
+                if reassign:
+                    cluster_id, score = result if result is not None else (-1, None)
+                    ids.append(cluster_id)
+                    scores.append(float('nan') if score is None else score)
+                elif result is not None:
+                    sink.write(result[0], line, result[1])
+    if not reassign:
+        return
+    lineno = 0
+    tasks = [(path, s, e) for s, e in ranges]
+    for task, results in zip(tasks, parallel_map(reassign_chunk, tasks, workers, set_clusterer, (clusterer,))):
+        for line, result in zip(read_lines(*task), results):
+            if result is not None:
+                cluster_id, score = result
+                if cluster_id is None:
+                    cluster_id, score = ids[lineno], scores[lineno]
+                    score = None if math.isnan(score) else score
+                sink.write(cluster_id, line, score)
+            lineno += 1
@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+"""Buffered output with a configurable flush policy, shared by sclust and
+sclust-summarize.
+
+A policy is one of:
+    line    flush after every record (the interactive default)
+    eof     flush only when the output is closed
+    N       flush every N records, e.g. 1000
+    Tms     flush when T milliseconds have passed since the last flush, e.g. 500ms.
+            A timer flushes records left waiting when input goes quiet.
+"""
+import sys
+import threading
+import time
+
+
+class Writer:
+    """
+    Collect output records (str, or bytes for a binary stream) and write
+    them to a stream in large chunks.
+
+    >>> import io
+    >>> s = io.StringIO()
+    >>> w = Writer('2', s)
+    >>> w.write('a\\n')
+    >>> s.getvalue()
+    ''
+    >>> w.write('b\\n')
+    >>> s.getvalue()
+    'a\\nb\\n'
+    """
+    def __init__(self, policy='line', stream=None):
+        self.stream = stream if stream is not None else sys.stdout
+        self.every = None
+        self.interval = None
+        if policy == 'line':
+            self.every = 1
+        elif policy.endswith('ms'):
+            self.interval = float(policy[:-2]) / 1000.
+        elif policy != 'eof':
+            self.every = int(policy)
+            if self.every < 1:
+                raise ValueError('invalid flush policy %s' % policy)
+        self.buffer = []
+        self.last_flush = time.time()
+        # With an interval, the timer thread flushes too, under lock, and
+        # leaves any error it hits for the next call to raise.
+        self.lock = threading.Lock()
+        self.timer = None
+        self.error = None
+
+    def write(self, record):
+        if self.interval is not None:
+            with self.lock:
+                self.buffer.append(record)
+                if time.time() - self.last_flush >= self.interval:
+                    self._flush()
+                elif self.timer is None:
+                    self.timer = threading.Timer(self.last_flush + self.interval - time.time(),
+                                                 self.timed_flush)
+                    self.timer.daemon = True
+                    self.timer.start()
+            return
+        self.buffer.append(record)
+        if self.every is not None and len(self.buffer) >= self.every:
+            self._flush()
+
+    def timed_flush(self):
+        with self.lock:
+            self.timer = None
+            try:
+                if len(self.buffer) > 0:
+                    self._flush()
+            except Exception as e:
+                self.error = e
+
+    def flush(self):
+        with self.lock:
+            self._flush()
+
+    def _flush(self):
+        if self.error is not None:
+            raise self.error
+        if len(self.buffer) > 0:
+            # Records are all str or all bytes; join them with an empty one.
+            self.stream.write(self.buffer[0][:0].join(self.buffer))
+            self.buffer = []
+        self.stream.flush()
+        self.last_flush = time.time()
+
+    def close(self):
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            self._flush()
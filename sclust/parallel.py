@@ -0,0 +1,229 @@
+# -*- coding: utf-8 -*-
+"""Cluster with several worker processes, each running a Clusterer over one
+shard of the input.
+
+The main process reads blocks of lines and routes each line by its rarest
+term already seen, so similar lines tend to share a shard. A term seen for
+the first time cannot match any cluster, so it is not used for routing.
+With each block, a worker also receives the document frequencies of the
+lines that went to other shards in earlier blocks, so its idfs lag the
+global ones by at most one block.
+
+Results are written in input order. Global cluster ids are numbered in
+order of first appearance. When a line starts a cluster in one shard,
+clusters recently started in other shards are checked first. If one was
+started by a line whose token set has Jaccard similarity of at least
+RECONCILE_JACCARD with this line, the new cluster takes that id instead.
+Workers report the local ids of clusters they prune or evict, so the map
+from local to global ids only holds live clusters.
+"""
+from collections import Counter, defaultdict, deque
+from itertools import islice
+import multiprocessing
+import sys
+import zlib
+
+from .sclust import Clusterer, tokenize
+
+RECONCILE_JACCARD = .8
+# How many recently started clusters are kept for reconciliation.
+RECONCILE_CLUSTERS = 100000
+
+
+def shard_of(tokens, doc_freqs, workers):
+    """
+    Return the shard of a line with token set tokens.
+
+    >>> shard_of({'a', 'b'}, Counter({'a': 3, 'b': 1}), 4) == shard_of({'b', 'c'}, Counter({'b': 1}), 4)
+    True
+    """
+    seen = [t for t in tokens if doc_freqs[t] > 0]
+    term = min(seen, key=lambda t: (doc_freqs[t], t)) if seen else min(tokens)
+    return zlib.crc32(term.encode('utf-8')) % workers
+
+
+class Reconciler:
+    """
+    Map the (shard, local id) of each cluster to a global id, merging a new
+    cluster into a recent cluster of another shard whose first line had a
+    near-identical token set.
+
+    >>> r = Reconciler()
+    >>> r.assign(0, 0, {'a', 'b', 'c', 'd', 'e'}, Counter())
+    0
+    >>> r.assign(1, 0, {'a', 'b', 'c', 'd', 'e'}, Counter())
+    0
+    >>> r.assign(1, 1, {'x', 'y'}, Counter())
+    1
+    >>> r.assign(1, 0, None, Counter())
+    0
+    >>> r.forget(1, [0, 1])
+    >>> len(r.ids)
+    1
+    """
+    def __init__(self, jaccard=RECONCILE_JACCARD, size=RECONCILE_CLUSTERS):
+        self.jaccard = jaccard
+        self.size = size
+        self.ids = {}
+        self.count = 0
+        self.recent = deque()
+        self.terms = {}
+        self.index = defaultdict(set)
+
+    def assign(self, shard, local_id, tokens, doc_freqs):
+        """ Return the global id of cluster local_id of shard. tokens is the
+        token set of the line that started it, if this is that line. """
+        key = (shard, local_id)
+        gid = self.ids.get(key)
+        if gid is None:
+            gid = self.match(shard, tokens, doc_freqs)
+            if gid is None:
+                gid = self.count
+                self.count += 1
+                self.add(gid, shard, frozenset(tokens))
+            self.ids[key] = gid
+        return gid
+
+    def forget(self, shard, local_ids):
+        """ Drop the ids of clusters removed from shard. """
+        for local_id in local_ids:
+            self.ids.pop((shard, local_id), None)
+
+    def match(self, shard, tokens, doc_freqs):
+        """ Return the most similar recent cluster of another shard, if any is
+        similar enough. Any token set that similar shares one of the rarest
+        int((1 - j) / j * |tokens|) + 1 tokens, so only those are looked up. """
+        nprefix = int((1 - self.jaccard) / self.jaccard * len(tokens)) + 1
+        prefix = sorted(tokens, key=lambda t: (doc_freqs[t], t))[:nprefix]
+        best, best_sim = None, self.jaccard
+        for gid in set().union(*[self.index.get(t, ()) for t in prefix]):
+            other_shard, terms = self.terms[gid]
+            if other_shard == shard:
+                continue
+            sim = len(terms.intersection(tokens)) / len(terms.union(tokens))
+            if sim > best_sim or (sim == best_sim and (best is None or gid < best)):
+                best, best_sim = gid, sim
+        return best
+
+    def add(self, gid, shard, tokens):
+        self.terms[gid] = (shard, tokens)
+        for t in tokens:
+            self.index[t].add(gid)
+        self.recent.append(gid)
+        if len(self.recent) > self.size:
+            old = self.recent.popleft()
+            for t in self.terms.pop(old)[1]:
+                postings = self.index[t]
+                postings.discard(old)
+                if len(postings) == 0:
+                    del self.index[t]
+
+
+def worker(conn, clusterer_kwargs, batch_size):
+    """ Cluster blocks received on conn, sending back the result of each
+    line and the ids of the clusters removed while clustering them. """
+    clusterer = Clusterer(**clusterer_kwargs)
+    live = set()
+    while True:
+        message = conn.recv()
+        if message is None:
+            break
+        lines, doc_freqs, nlines = message
+        clusterer.observe(doc_freqs, nlines)
+        results = list(clusterer.assign_many(lines, batch_size))
+        live.update(r[0] for r in results if r is not None and r[1] is None)
+        removed = []
+        if len(clusterer.clusters) < len(live):
+            current = {c._id for c in clusterer.clusters}
+            removed = list(live - current)
+            live = current
+        conn.send((results, removed))
+    conn.close()
+
+
+def run_sharded(clusterer_kwargs, workers, sink, batch_size=1, block_size=1000, stream=None):
+    """
+    Cluster the lines of stream (stdin by default) with workers processes,
+    each running a Clusterer(**clusterer_kwargs), block_size lines at a
+    time, and write the cluster id, line and score of each line to sink, as
+    sclust.run does. Lines are routed by their tokens from the clusterers'
+    tokenizer.
+    """
+    stream = stream if stream is not None else sys.stdin
+    tokenizer = clusterer_kwargs.get('tokenizer') or tokenize
+    conns, procs = [], []
+    for _ in range(workers):
+        conn, child = multiprocessing.Pipe()
+        proc = multiprocessing.Process(target=worker, args=(child, clusterer_kwargs, batch_size))
+        proc.daemon = True
+        proc.start()
+        conns.append(conn)
+        procs.append(proc)
+    doc_freqs = Counter()
+    pending = [(Counter(), 0) for _ in range(workers)]
+    reconciler = Reconciler()
+    outstanding = None
+    try:
+        while True:
+            lines = [line.strip() for line in islice(stream, block_size)]
+            block = None
+            if len(lines) > 0:
+                block = dispatch(lines, conns, doc_freqs, pending, tokenizer)
+            # Keep one block in flight while the previous one is written.
+            if outstanding is not None:
+                collect(outstanding, conns, reconciler, doc_freqs, sink)
+            outstanding = block
+            if block is None:
+                break
+    finally:
+        for conn in conns:
+            conn.send(None)
+        for proc in procs:
+            proc.join()
+
+
+def dispatch(lines, conns, doc_freqs, pending, tokenizer=tokenize):
+    """ Route a block of lines to the workers. Returns what collect needs
+    to write their results. """
+    workers = len(conns)
+    shards = [[] for _ in range(workers)]
+    token_sets = []
+    block_freqs = [Counter() for _ in range(workers)]
+    for i, line_tokens in enumerate(tokenizer.tokenize_many(lines)):
+        tokens = set(line_tokens)
+        token_sets.append(tokens)
+        if len(tokens) > 0:
+            shard = shard_of(tokens, doc_freqs, workers)
+            shards[shard].append(i)
+            # Term counts, as the worker counts its own lines.
+            block_freqs[shard].update(line_tokens)
+            doc_freqs.update(tokens)
+    for s, conn in enumerate(conns):
+        freqs, nlines = pending[s]
+        conn.send(([lines[i] for i in shards[s]], freqs, nlines))
+        pending[s] = (Counter(), len(lines) - len(shards[s]))
+        for other, other_freqs in enumerate(block_freqs):
+            if other != s:
+                pending[s][0].update(other_freqs)
+    return lines, token_sets, shards
+
+
+def collect(block, conns, reconciler, doc_freqs, sink):
+    """ Receive the results of a dispatched block and write them to sink in input order. """
+    lines, token_sets, shards = block
+    results = [None] * len(lines)
+    removed = []
+    for s, conn in enumerate(conns):
+        shard_results, shard_removed = conn.recv()
+        for i, result in zip(shards[s], shard_results):
+            if result is not None:
+                results[i] = (s, result)
+        removed.append(shard_removed)
+    for line, tokens, result in zip(lines, token_sets, results):
+        if result is None:
+            continue
+        shard, (local_id, score) = result
+        cluster_id = reconciler.assign(shard, local_id, tokens if score is None else None, doc_freqs)
+        sink.write(cluster_id, line, score)
+    for s, local_ids in enumerate(removed):
+        reconciler.forget(s, local_ids)
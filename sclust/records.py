@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+"""Record formats shared by sclust and sclust-summarize.
+
+A format is one of:
+    text    tab-separated lines: cluster id, line, and score ('-' for a
+            line that started a cluster)
+    json    one JSON object per line, e.g.
+            {"cluster": 3, "text": "i like to sing", "score": 0.53}
+    binary  records prefixed by their length as a little-endian uint32.
+            An assignment is the cluster id (int64) and score (float64,
+            NaN for a line that started a cluster) followed by the line in
+            UTF-8. Summaries are UTF-8 JSON.
+
+Unlike text, json and binary records can hold lines with tabs.
+"""
+import json
+import math
+import struct
+
+from .output import Writer
+
+FORMATS = ('text', 'json', 'binary')
+LENGTH = struct.Struct('<I')
+ASSIGNMENT = struct.Struct('<qd')
+
+
+def check_format(fmt):
+    if fmt not in FORMATS:
+        raise ValueError('unknown format %s' % fmt)
+    return fmt
+
+
+def frame(payload):
+    """ Return payload (bytes) prefixed by its length. """
+    return LENGTH.pack(len(payload)) + payload
+
+
+def read_frames(stream):
+    """ Yield the payloads of the length-prefixed records of a binary stream. """
+    while True:
+        header = stream.read(LENGTH.size)
+        if len(header) < LENGTH.size:
+            return
+        yield stream.read(LENGTH.unpack(header)[0])
+
+
+def format_assignment(fmt, cluster_id, text, score):
+    """
+    Return the record of one line of sclust output, as a str, or bytes for
+    the binary format.
+
+    >>> format_assignment('text', 3, 'i like to sing', None)
+    '3\\ti like to sing\\t-\\n'
+    >>> format_assignment('json', 3, 'i like\\tto sing', .5)
+    '{"cluster": 3, "text": "i like\\\\tto sing", "score": 0.5}\\n'
+    >>> list(read_assignments('binary', __import__('io').BytesIO(format_assignment('binary', 3, 'sing', None))))
+    [(3, 'sing', None)]
+    """
+    if fmt == 'text':
+        if score is None:
+            return '%d\t%s\t-\n' % (cluster_id, text)
+        return '%d\t%s\t%g\n' % (cluster_id, text, score)
+    if fmt == 'json':
+        return json.dumps({'cluster': cluster_id, 'text': text, 'score': score}) + '\n'
+    return frame(ASSIGNMENT.pack(cluster_id, float('nan') if score is None else score) + text.encode('utf-8'))
+
+
+def _parse_score(field):
+    if field == '-':
+        return None
+    try:
+        return float(field)
+    except ValueError:
+        return field
+
+
+def read_assignments(fmt, stream):
+    """
+    Yield (cluster id, line, score) for each record of sclust output. The
+    score is None for a line that started a cluster. Cluster ids read from
+    text are left as strings.
+    """
+    if fmt == 'text':
+        for line in stream:
+            fields = line.strip().split('\t')
+            if len(fields) > 2:
+                yield fields[0], '\t'.join(fields[1:-1]), _parse_score(fields[-1])
+            else:
+                yield fields[0], '\t'.join(fields[1:]), None
+    elif fmt == 'json':
+        for line in stream:
+            record = json.loads(line)
+            yield record['cluster'], record['text'], record['score']
+    else:
+        for payload in read_frames(stream):
+            cluster_id, score = ASSIGNMENT.unpack_from(payload)
+            yield cluster_id, payload[ASSIGNMENT.size:].decode('utf-8'), None if math.isnan(score) else score
+
+
+def format_summary(fmt, summary):
+    """ Return the record of a summary, a JSON-serializable dict, in the
+    json or binary format. """
+    if fmt == 'json':
+        return json.dumps(summary) + '\n'
+    return frame(json.dumps(summary).encode('utf-8'))
+
+
+class AssignmentWriter:
+    """ Write the assignments of sclust as records of a format, flushed by a
+    sclust.output policy. """
+    def __init__(self, fmt='text', flush='line', stream=None):
+        self.fmt = check_format(fmt)
+        self.out = Writer(flush, stream)
+
+    def write(self, cluster_id, line, score):
+        self.out.write(format_assignment(self.fmt, cluster_id, line, score))
+
+    def flush(self):
+        self.out.flush()
+
+    def close(self):
+        self.out.close()
@@ -2,25 +2,146 @@
 """A command-line tool to quickly cluster sentences.
 
 usage:
-    sclust [--help --threshold <T> --prune-frequency <P> --min-match <M> --term-filter <K>]
+    sclust [--help --threshold <T> --prune-frequency <P> --min-size <S> --prune-incremental --min-match <M> --term-filter <K> --engine <E> --batch-size <B> --save-state <FILE> --load-state <FILE> --checkpoint-every <C> --max-clusters <N> --max-memory <MB> --eviction <E> --flush <F> --stats-every <N> --stats-file <FILE> --retrieval <R> --max-postings <L> --lsh-bands <B> --lsh-rows <R> --duplicate-cache <N> --workers <W> --exchange-every <L> --format <F> --summarize <F> --summarize-clusters <N> --summarize-docs <K> --serve <ADDR> --batch-wait <MS> --offline <FILE> --idf-table <FILE> --reassign --max-terms <M> --consolidate-every <N> --consolidate-clusters <M> --merge-threshold <S> --remap-file <FILE> --hash-buckets <N> --df-half-life <L> --token-pattern <RE> --normalize <N> --stopwords <S> --io-threads --read-ahead <N> --offsets] [<file>...]
 
 Options
     -h, --help
     -p, --prune-frequency <P>   Delete small clusters every P lines [default: -1]
+    -z, --min-size <S>          Clusters with fewer than S lines are small. [default: 3]
+    -i, --prune-incremental     Instead of checking all clusters every P lines, check a few on every line so that all are checked once every P lines. Clusters younger than P lines are kept.
     -t, --threshold <N>         Similarity threshold in [0,1]. Higher means sentences must be more similar to be merged. [default: .2]
     -m, --min-match <M>         Minimum number of words that must match to place a document in a cluster. [default: 2]
     -k, --term-filter <K>       Use the top K terms from each document to get a reduced set of possible matches.[default: 5]
+    -e, --engine <E>            How to score candidate clusters: dict (pure Python) or numpy (sparse matrix). numpy is slower at the defaults and pays off only with many candidates per line, e.g. -m 1 -k 10. [default: dict]
+    -b, --batch-size <B>        Read, tokenize and score B lines at a time. Lines within a batch share document frequencies. Batching helps when lines have few candidates; with many (e.g. -m 1 -k 10), candidates changed within a batch are rescored line by line and it can be slower. [default: 1]
+    -s, --save-state <FILE>     Save clusters, index and document frequencies to FILE at the end of input.
+    -l, --load-state <FILE>     Resume from a state saved with --save-state.
+    -c, --checkpoint-every <C>  Also save the state every C lines. [default: -1]
+    -x, --max-clusters <N>      Evict clusters once there are more than N. [default: -1]
+    -y, --max-memory <MB>       Evict clusters once they use more than about MB megabytes. [default: -1]
+    -v, --eviction <E>          Which clusters to evict: lru (least recently assigned), smallest, or score (size divided by lines since last assigned). [default: lru]
+    --flush <F>                 When to flush output: line, eof, every N lines, or every T milliseconds (e.g. 500ms). [default: line]
+    --stats-every <N>           Every N lines, report throughput, sizes, candidates per line and time per stage as a JSON line. [default: -1]
+    --stats-file <FILE>         Append the reports of --stats-every to FILE instead of stderr.
+    -r, --retrieval <R>         How to find candidate clusters: exhaustive (count every posting of the top K terms), maxscore (only the shortest posting lists can add candidates, and lines that cannot score above the threshold are not searched), or lsh (clusters sharing a band of MinHash signatures with the line). [default: exhaustive]
+    --max-postings <L>          With --retrieval maxscore, only the L largest clusters of a longer posting list can become candidates. [default: -1]
+    --lsh-bands <B>             With --retrieval lsh, the number of MinHash bands. More bands find more candidates. [default: 32]
+    --lsh-rows <R>              With --retrieval lsh, the MinHash values per band. More rows require closer matches. [default: 2]
+    -d, --duplicate-cache <N>   Remember the clusters of the last N distinct lines, and send repeats of them straight to the same cluster, skipping retrieval and scoring. [default: -1]
+    -w, --workers <W>           Cluster with W processes, each given a shard of the lines. Cluster ids stay global and output stays in input order. [default: 1]
+    --exchange-every <L>        With --workers, the number of lines per block; workers share document frequencies once per block. [default: 1000]
+    --format <F>                Output format: text (cluster id, line and score, tab-separated), json (JSON lines) or binary (length-prefixed records). See sclust.records. [default: text]
+    --summarize <F>             Instead of every line, write a summary of the top clusters every F lines, as sclust | sclust-summarize would. [default: -1]
+    --summarize-clusters <N>    With --summarize, the number of clusters per summary. [default: 10]
+    --summarize-docs <K>        With --summarize, the number of lines per cluster. [default: 3]
+    --serve <ADDR>              Keep running and answer JSON requests on a socket, unix:PATH or HOST:PORT, instead of reading stdin. Not with --workers. See sclust.server.
+    --batch-wait <MS>           With --serve, how long to gather requests into a micro-batch, in milliseconds. [default: 2]
+    --offline <FILE>            Cluster FILE instead of stdin, with idfs from the document frequencies of the whole file, counted by --workers processes. See sclust.offline.
+    --idf-table <FILE>          With --offline, read document frequencies from FILE if it exists, else save them there. A FILE counted from another input file or with other tokenizer options is refused.
+    --reassign                  With --offline, finally reassign every line to the best of the final clusters, with --workers processes.
+    --max-terms <M>             Keep only the M terms of a new cluster's first line with the highest tf-idf, and index clusters under those terms only, not under every token of their lines. [default: -1]
+    --consolidate-every <N>     Every N lines, merge clusters whose tf-idf centroids are similar. [default: -1]
+    --consolidate-clusters <M>  Also merge similar clusters after every M new clusters. [default: -1]
+    --merge-threshold <S>       Merge clusters whose centroids have cosine similarity of at least S. [default: .5]
+    --remap-file <FILE>         Append a line for each merge to FILE instead of stderr: the line number, the merged cluster id, and the id it was merged into.
+    --hash-buckets <N>          Hash tokens into N term ids and keep document frequencies in an array of N counts, so term statistics take constant memory. Tokens sharing a bucket are one term. [default: -1]
+    --df-half-life <L>          With --hash-buckets, halve the weight of each line in document frequencies every L lines, so idfs follow the recent stream. [default: -1]
+    --token-pattern <RE>        Tokens are the matches of this regular expression in the lowercased line. [default: \\w+]
+    --normalize <N>             Comma-separated normalizers that replace parts of a line with a placeholder token before tokenizing: url (webaddress), mention (usermention), number (number). See sclust.tokenizer.
+    --stopwords <S>             Drop stopwords from tokens: english, or a file with one stopword per line.
+    --io-threads                Read input in large blocks and write output on background threads, so clustering overlaps with I/O. --stats-every then also reports queue depths and the seconds spent waiting on input and output. See sclust.streams.
+    --read-ahead <N>            With --io-threads and several files, read and decompress up to N files ahead of the one being clustered. [default: 1]
+    --offsets                   Write the file and line number of each line, as FILE:N (- for stdin), instead of its text.
+
+Lines are read from the files given, in turn, or from stdin if none are (- also means stdin). gzip, bz2 and xz files are decompressed as they are read.
 """
-from collections import Counter, defaultdict
+from array import array
+from collections import Counter, OrderedDict, defaultdict
 from docopt import docopt
+from itertools import islice
 from math import sqrt, log10
-import numpy as np
-import re
+import heapq
+import json
 import sys
+import time
+
+from . import state
+from .hashing import BucketCounts, HashedVocabulary
+from .lsh import LSHScorer
+from .records import AssignmentWriter
+from .sclust_summarize import Summarizer
+from .streams import BackgroundStream, FileReader
+from .tokenizer import Tokenizer, build_tokenizer
+
+# Split a line into lowercase tokens of word characters.
+tokenize = Tokenizer()
+
+
+class Vocabulary:
+    """
+    Interns tokens as small integer ids, so that clusters, the index and
+    doc_freqs store ints instead of strings. Ids of forgotten tokens are reused.
+
+    >>> v = Vocabulary()
+    >>> v.intern(['cat', 'dog', 'cat'])
+    [0, 1, 0]
+    >>> v[1]
+    'dog'
+    >>> v.forget([0])
+    >>> v.intern(['bird'])
+    [0]
+    >>> v.count(['cat', 'dog', 'cat'])
+    Counter({2: 2, 1: 1})
+    """
+    def __init__(self, tokens=()):
+        self.tokens = list(tokens)
+        self.ids = {t: i for i, t in enumerate(self.tokens) if t}
+        self.free = [i for i, t in enumerate(self.tokens) if not t]
+
+    def __len__(self):
+        return len(self.ids)
 
+    def __getitem__(self, i):
+        return self.tokens[i]
 
-def tokenize(line):
-    return re.findall('\w+', line.lower())
+    def lookup(self, tokens):
+        """ Return the ids of the tokens that have one, skipping the others. """
+        ids = self.ids
+        return [ids[t] for t in tokens if t in ids]
+
+    def count(self, tokens):
+        """ Return a Counter of the ids of tokens, interning new ones. """
+        ids = self.ids
+        counts = Counter.__new__(Counter)
+        get = counts.get
+        for t in tokens:
+            i = ids.get(t)
+            if i is None:
+                i = self.intern((t,))[0]
+            counts[i] = get(i, 0) + 1
+        return counts
+
+    def intern(self, tokens):
+        ids = self.ids
+        result = []
+        for t in tokens:
+            i = ids.get(t)
+            if i is None:
+                if self.free:
+                    i = self.free.pop()
+                    self.tokens[i] = t
+                else:
+                    i = len(self.tokens)
+                    self.tokens.append(t)
+                ids[t] = i
+            result.append(i)
+        return result
+
+    def forget(self, ids):
+        for i in ids:
+            del self.ids[self.tokens[i]]
+            self.tokens[i] = ''
+            self.free.append(i)
 
 
 def idf(token, doc_freqs, docnum):
@@ -28,110 +149,986 @@ def idf(token, doc_freqs, docnum):
 
 
 class Cluster:
+    """
+    A cluster centroid, stored as parallel arrays of term ids and the total
+    count of each term over the cluster's lines. As in the original
+    algorithm, a cluster's terms are those of the line that created it.
+
+    >>> c = Cluster(0, {1: 2, 2: 1})
+    >>> c.term_scores[1]  # doctest: +ELLIPSIS
+    0.666...
+    >>> c.score({1: 10}, {1: .5})  # doctest: +ELLIPSIS
+    3.333...
+    >>> c.add({1: 3, 2: 4})
+    >>> c.term_scores[1]
+    0.5
+    >>> c.term_scores[2]
+    0.5
+    >>> c.merge(Cluster(1, {2: 1, 3: 1}))
+    >>> c.size, c.term_scores[2]
+    (3, 0.5)
+    """
+    __slots__ = ('_id', 'size', 'terms', 'created', 'updated', 'term_ids', 'weights', 'total_tokens')
+
     def __init__(self, _id, token_counts):
-        """
-        >>> c = Cluster({'cat': 2, 'dog': 1})
-        >>> c.term_scores['cat']  # doctest: +ELLIPSIS
-        0.666...
-        >>> c.score({'cat': 10}, {'cat': .5})  # doctest: +ELLIPSIS
-        3.333...
-        >>> c.add({'cat': 3, 'dog': 4})
-        >>> c.term_scores['cat']
-        0.5
-        >>> c.term_scores['dog']
-        0.5
-        """
         self._id = _id
         self.size = 1
-        self.term_scores = token_counts
+        self.terms = array('l')  # terms this cluster is indexed under
+        self.created = 0  # line number that created this cluster
+        self.updated = 0  # line number last assigned to this cluster
+        self.term_ids = array('l', token_counts.keys())
+        self.weights = array('d', token_counts.values())
         self.total_tokens = sum(token_counts.values())
-        for t, v in token_counts.items():
-            self.term_scores[t] = v / self.total_tokens
 
     def __hash__(self):
         return self._id
 
+    @property
+    def term_scores(self):
+        return {t: w / self.total_tokens for t, w in zip(self.term_ids, self.weights)}
+
+    @property
+    def term_weights(self):
+        return dict(zip(self.term_ids, self.weights))
+
     def add(self, token_counts):
-        new_total_tokens = self.total_tokens + sum(token_counts.values())
-        for t, v in self.term_scores.items():
-            self.term_scores[t] = ((v * self.total_tokens) + token_counts[t]) / new_total_tokens
-        self.total_tokens = new_total_tokens
+        weights = self.weights
+        for i, t in enumerate(self.term_ids):
+            v = token_counts.get(t)
+            if v:
+                weights[i] += v
+        self.total_tokens += sum(token_counts.values())
         self.size += 1
 
+    def merge(self, other):
+        """ Absorb the lines of cluster other, as if they had been added here. """
+        weights, other_weights = self.weights, other.term_weights
+        for i, t in enumerate(self.term_ids):
+            v = other_weights.get(t)
+            if v:
+                weights[i] += v
+        self.total_tokens += other.total_tokens
+        self.size += other.size
+
+    def dot(self, query):
+        """ Return the score for a line given its weight (count * idf) for each term. """
+        total = 0.
+        for t, w in zip(self.term_ids, self.weights):
+            v = query.get(t)
+            if v:
+                total += v * w
+        return total / self.total_tokens
+
     def score(self, token_counts, idfs):
-        return sum(value * self.term_scores[token] * idfs[token] for token, value in token_counts.items())
+        return self.dot({t: v * idfs[t] for t, v in token_counts.items()})
+
+
+class DictScorer:
+    """
+    Score candidates one at a time with Cluster.dot.
+    """
+    def new_cluster(self, _id, tokens):
+        return Cluster(_id, tokens)
+
+    def add(self, cluster, tokens):
+        cluster.add(tokens)
+
+    def merge(self, cluster, other):
+        cluster.merge(other)
+
+    def restore(self, _id, size, total_tokens, term_weights):
+        cluster = Cluster(_id, term_weights)
+        cluster.size = size
+        cluster.total_tokens = total_tokens
+        return cluster
+
+    def score(self, clusters, tokens, idfs):
+        query = {t: v * idfs[t] for t, v in tokens.items()}
+        return [cluster.dot(query) for cluster in clusters]
+
+    def score_many(self, queries, idfs):
+        return [self.score(clusters, tokens, idfs) for clusters, tokens in queries]
+
+    def best(self, clusters, scores, threshold):
+        """
+        Return the highest scoring cluster above threshold and its score, or (None, -1).
+        Ties go to the earliest cluster.
+        """
+        best_cluster = None
+        best_score = -1
+        for cluster, score in zip(clusters, scores):
+            if score > best_score and score > threshold:
+                best_cluster = cluster
+                best_score = score
+        return best_cluster, best_score
+
+    def remove(self, clusters):
+        pass
+
+
+def make_scorer(engine):
+    if engine == 'dict':
+        return DictScorer()
+    elif engine == 'numpy':
+        from .matrix import MatrixScorer
+        return MatrixScorer()
+    raise ValueError('unknown engine %s' % engine)
+
 
 def update_index(index, cluster, tokens):
     for t in tokens:
-        index[t].add(cluster)
+        postings = index[t]
+        if cluster not in postings:
+            postings.add(cluster)
+            cluster.terms.append(t)
 
 def search_index(index, top_words, min_match=2):
     # Require at least min_match terms to match.
     clusters = Counter()
     for w in top_words:
-        clusters.update(index[w])
+        clusters.update(index.get(w, ()))
+    return [c for c, v in clusters.items() if v >= min_match]
+
+class TopPostings:
+    """
+    For terms with more than max_postings postings, cache the max_postings
+    largest clusters. A term's list is rebuilt once it is max_postings lines
+    old, so the cost of sorting is spread over the lines that use it.
+    """
+    def __init__(self, max_postings):
+        self.max_postings = max_postings
+        self.cache = {}
+
+    def get(self, term, postings, docnum):
+        entry = self.cache.get(term)
+        if entry is None or docnum - entry[0] >= self.max_postings:
+            entry = (docnum, heapq.nlargest(self.max_postings, postings, key=lambda c: c.size))
+            self.cache[term] = entry
+        # Skip clusters removed since the list was built.
+        return [c for c in entry[1] if c in postings]
+
+def search_index_pruned(index, top_words, min_match=2, top_postings=None, docnum=0):
+    """
+    Like search_index, but cheaper for common terms. Words are visited from
+    the shortest posting list to the longest. A cluster must match min_match
+    of the words, so only the first len(top_words) - min_match + 1 lists can
+    add new candidates; the longer lists are only probed for clusters already
+    found. If top_postings is given, long lists that add candidates are
+    replaced by their largest clusters.
+    """
+    words = sorted(top_words, key=lambda w: len(index.get(w, ())))
+    nessential = len(words) - min_match + 1
+    clusters = Counter()
+    for w in words[:max(0, nessential)]:
+        postings = index.get(w)
+        if postings:
+            if top_postings is not None and len(postings) > top_postings.max_postings:
+                postings = top_postings.get(w, postings, docnum)
+            clusters.update(postings)
+    for w in words[max(0, nessential):]:
+        postings = index.get(w)
+        if postings:
+            if len(postings) > len(clusters):
+                postings = postings.intersection(clusters)
+            # Clusters first seen here cannot reach min_match, so counting
+            # the whole list is fine when it is the shorter one.
+            clusters.update(postings)
     return [c for c, v in clusters.items() if v >= min_match]
 
-def prune_clusters(clusters, index, n=3):
+class DuplicateCache:
+    """
+    An LRU map from the token counts of a line to the cluster it was last
+    assigned to. Clusters that have since been removed are never returned.
+
+    >>> cache = DuplicateCache(2)
+    >>> index = defaultdict(set)
+    >>> c = Cluster(0, {1: 1})
+    >>> update_index(index, c, [1])
+    >>> cache.put(cache.key({1: 1}), c)
+    >>> cache.get(cache.key({1: 1})) is c
+    True
+    >>> remove_clusters([c], index)
+    >>> cache.get(cache.key({1: 1})) is None
+    True
+    """
+    def __init__(self, size):
+        self.size = size
+        self.entries = OrderedDict()
+
+    def key(self, tokens):
+        return frozenset(tokens.items())
+
+    def get(self, key):
+        cluster = self.entries.get(key)
+        if cluster is None:
+            return None
+        if len(cluster.terms) == 0:
+            del self.entries[key]
+            return None
+        self.entries.move_to_end(key)
+        return cluster
+
+    def put(self, key, cluster):
+        self.entries[key] = cluster
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+def remove_clusters(torem, index, scorer=None):
+    """
+    Remove clusters from the postings of the terms they are indexed under.
+    A removed cluster is left with no terms.
+    """
+    for c in torem:
+        for t in c.terms:
+            postings = index[t]
+            postings.discard(c)
+            if len(postings) == 0:
+                del index[t]
+        del c.terms[:]
+    if scorer is not None:
+        scorer.remove(torem)
+
+def prune_clusters(clusters, index, n=3, scorer=None):
     """
     Delete clusters with fewer than n elements.
     """
-    torem = set(c for c in clusters if c.size < n)
+    torem = [c for c in clusters if c.size < n]
+    remove_clusters(torem, index, scorer)
     pruned_clusters = [c for c in clusters if c.size >= n]
-    terms_torem = []
-    for term, clusters in index.items():
-        index[term] = clusters - torem
-        if len(index[term]) == 0:
-            terms_torem.append(term)
-    for t in terms_torem:
-        del index[t]
     return pruned_clusters, index
 
-def run(threshold, prune_freq, min_match, term_filter):
-    cluster_count = 0
-    doc_freqs = Counter()
-    clusters = []
-    docnum = 0
-    index = defaultdict(set)
-    nmatch = 0
-    for line in sys.stdin:
-        docnum += 1
-        line = line.strip()
-        tokens = Counter(tokenize(line))
-        if len(tokens) == 0:
-            continue
-        doc_freqs.update(tokens)
-        idfs = {token: idf(token, doc_freqs, docnum) for token in tokens}
+def prune_step(clusters, index, start, count, n=3, created_before=None, scorer=None):
+    """
+    Delete clusters with fewer than n elements among the count clusters
+    starting at position start. If created_before is given, only clusters
+    created before that line are deleted. clusters is modified in place.
+    Returns the position to start from on the next step.
+    """
+    if start >= len(clusters):
+        start = 0
+    end = min(start + count, len(clusters))
+    segment = clusters[start:end]
+    torem = [c for c in segment if c.size < n and (created_before is None or c.created < created_before)]
+    if len(torem) > 0:
+        remove_clusters(torem, index, scorer)
+        removed = set(torem)
+        clusters[start:end] = [c for c in segment if c not in removed]
+    return end - len(torem)
+
+# Rough memory cost, in bytes, of a cluster, of a posting (the index entry plus the
+# cluster's term and centroid entries), and of a vocabulary entry plus its doc_freqs count.
+CLUSTER_BYTES = 300
+POSTING_BYTES = 110
+TERM_BYTES = 150
+# How often to check memory usage.
+MEMORY_CHECK_LINES = 1000
+
+def memory_usage(clusters, doc_freqs):
+    """
+    Estimate the memory used by clusters, the index and doc_freqs, in bytes.
+    """
+    npostings = sum(len(c.terms) for c in clusters)
+    terms = doc_freqs.nbytes if isinstance(doc_freqs, BucketCounts) else TERM_BYTES * len(doc_freqs)
+    return CLUSTER_BYTES * len(clusters) + POSTING_BYTES * npostings + terms
+
+# Functions of (cluster, current line number); clusters with the lowest values are evicted first.
+EVICTION_POLICIES = {
+    'lru': lambda c, docnum: c.updated,
+    'smallest': lambda c, docnum: (c.size, c.updated),
+    'score': lambda c, docnum: c.size / (docnum - c.updated + 1.),
+}
+
+def evict_clusters(clusters, index, count, policy='lru', docnum=0, scorer=None):
+    """
+    Delete the count clusters that rank lowest under the eviction policy.
+    """
+    key = EVICTION_POLICIES[policy]
+    torem = set(heapq.nsmallest(count, clusters, key=lambda c: key(c, docnum)))
+    remove_clusters(torem, index, scorer)
+    return [c for c in clusters if c not in torem], index
+
+def forget_rare_terms(doc_freqs, index, vocab=None):
+    """
+    Delete terms seen in only one document that no cluster is indexed under.
+    """
+    rare = [t for t, v in doc_freqs.items() if v == 1 and t not in index]
+    for t in rare:
+        del doc_freqs[t]
+    if vocab is not None:
+        vocab.forget(rare)
+
+class Clusterer:
+    """
+    Online clusterer for lines of text; the state behind the sclust command.
+
+    Lines are assigned in blocks. All lines in a block are tokenized, given
+    idfs from the block's document frequencies, and matched against the
+    clusters that existed before the block in one pass. They are then
+    assigned in input order; candidates that changed earlier in the block
+    are rescored, and clusters created earlier in the block are also searched.
+    A block of one line is the plain online algorithm.
+
+    If there are more than max_clusters clusters, or they take more than
+    max_memory megabytes, clusters are evicted by the eviction policy until
+    10% under budget.
+
+    With retrieval='maxscore', candidates come from search_index_pruned,
+    which finds the same clusters as search_index but may list them in a
+    different order, so exact ties can break differently. A line's score can
+    never exceed its largest count * idf, so lines where that is under the
+    threshold start a new cluster without retrieval. With max_postings, only
+    the largest max_postings clusters of a long posting list can be added as
+    candidates. With retrieval='lsh', candidates are the clusters that share
+    a band of their MinHash signature with the line (see lsh.py), and
+    min_match and term_filter only apply to clusters created in the same
+    block.
+
+    With duplicate_cache, a line with the same token counts as one of the
+    last duplicate_cache distinct lines goes straight to the cluster that
+    line was assigned to, if it still exists, without retrieval or scoring
+    against other candidates.
+
+    With max_terms, a new cluster keeps only the max_terms terms of its
+    first line with the highest count * idf, and clusters are indexed under
+    their centroid terms only, rather than every token of every line
+    assigned to them, so each cluster has at most max_terms postings. With
+    retrieval='lsh', signatures still take in every token of added lines.
+
+    Every consolidate_every lines, or after every consolidate_clusters new
+    clusters, consolidate merges clusters whose centroids are similar.
+
+    With hash_buckets, tokens are hashed into that many term ids, and
+    document frequencies are kept in an array (see sclust.hashing). With
+    df_half_life as well, they decay by half every df_half_life lines.
+
+    After freeze_idfs, idfs come from fixed document frequencies, such as
+    those of a whole file (see sclust.offline), instead of the lines
+    assigned so far.
+
+    Lines are split into tokens by tokenizer (see sclust.tokenizer), by
+    default the module's tokenize.
+
+    >>> c = Clusterer()
+    >>> list(c.assign_many(['Hi there, how are you?', 'hi where how you are', 'i like to sing']))
+    [(0, None), (1, None), (2, None)]
+    >>> c.assign('I am going to sing')  # doctest: +ELLIPSIS
+    (2, 0.298...)
+    >>> list(c.assign_many(['', 'hi where how you are']))  # doctest: +ELLIPSIS
+    [None, (1, 0.403...)]
+    >>> c.stats()['clusters']
+    3
+    >>> c.nearest('I am going to sing')  # doctest: +ELLIPSIS
+    (2, 0.283...)
+    >>> c.merge_threshold = .1
+    >>> c.consolidate()
+    [(0, 1)]
+    >>> c.freeze_idfs(Counter({'sing': 2, 'i': 3, 'to': 2}), 10)
+    >>> c.assign('I like to sing')  # doctest: +ELLIPSIS
+    (2, 0.570...)
+    """
+    def __init__(self, threshold=.2, prune_freq=-1, min_match=2, term_filter=5, engine='dict',
+                 min_size=3, prune_incremental=False, max_clusters=-1, max_memory=-1, eviction='lru',
+                 retrieval='exhaustive', max_postings=-1, lsh_bands=32, lsh_rows=2, duplicate_cache=-1,
+                 max_terms=-1, consolidate_every=-1, consolidate_clusters=-1, merge_threshold=.5,
+                 hash_buckets=-1, df_half_life=-1, tokenizer=None):
+        self.threshold = threshold
+        self.tokenizer = tokenizer if tokenizer is not None else tokenize
+        self.prune_freq = prune_freq
+        self.min_match = min_match
+        self.term_filter = term_filter
+        self.min_size = min_size
+        self.prune_incremental = prune_incremental
+        self.max_clusters = max_clusters
+        self.max_memory = max_memory
+        if eviction not in EVICTION_POLICIES:
+            raise ValueError('unknown eviction %s' % eviction)
+        self.eviction = eviction
+        if retrieval not in ('exhaustive', 'maxscore', 'lsh'):
+            raise ValueError('unknown retrieval %s' % retrieval)
+        self.retrieval = retrieval
+        self.top_postings = TopPostings(max_postings) if max_postings > 0 else None
+        self.scorer = make_scorer(engine)
+        if retrieval == 'lsh':
+            self.scorer = LSHScorer(self.scorer, lsh_bands, lsh_rows)
+        self.duplicates = DuplicateCache(duplicate_cache) if duplicate_cache > 0 else None
+        self.max_terms = max_terms
+        self.consolidate_every = consolidate_every
+        self.consolidate_clusters = consolidate_clusters
+        self.merge_threshold = merge_threshold
+        # The line number and new cluster count at the last consolidation.
+        self.consolidated = (0, 0)
+        # (line number, old id, new id) for each merge, for the caller to drain.
+        self.remaps = []
+        self.hash_buckets = hash_buckets
+        self.df_half_life = df_half_life
+        if hash_buckets > 0:
+            self.vocab = HashedVocabulary(hash_buckets)
+            self.doc_freqs = BucketCounts(hash_buckets, df_half_life)
+        elif df_half_life > 0:
+            raise ValueError('decaying document frequencies requires hashed terms')
+        else:
+            self.vocab = Vocabulary()
+            self.doc_freqs = Counter()
+        self.cluster_count = 0
+        # With freeze_idfs, the idf of each term id, and of terms not in it.
+        self.idf_table = None
+        self.default_idf = 0.
+        self.clusters = []
+        self.docnum = 0
+        self.index = defaultdict(set)
+        self.prune_pos = 0
+        # Running totals: docs (lines with tokens), candidates scored, new_clusters,
+        # duplicates (lines assigned by the duplicate cache), and seconds spent in each stage (tokenize, retrieve, score, prune, output).
+        self.counters = Counter()
+        self.max_candidates = 0
+
+    def load(self, path):
+        """ Replace the current state with a snapshot written by save. """
+        self.clusters, self.index, self.doc_freqs, self.docnum, self.cluster_count, self.vocab, scalars = \
+            state.load_state(path, self.scorer)
+        # Where consolidation left off, so the next pass compares only the
+        # clusters assigned lines since.
+        self.consolidated = tuple(scalars.get('consolidated', (0, 0)))
+        self.counters['new_clusters'] = scalars.get('new_clusters', 0)
+        self.prune_pos = scalars.get('prune_pos', 0)
+        if isinstance(self.doc_freqs, BucketCounts):
+            if len(self.doc_freqs) != self.hash_buckets:
+                raise ValueError('%s has %d hash buckets, expected %d' % (path, len(self.doc_freqs),
+                                                                        self.hash_buckets))
+            self.doc_freqs.half_life = self.df_half_life
+        elif self.hash_buckets > 0:
+            raise ValueError('%s does not have hashed terms' % path)
+        if self.retrieval == 'lsh':
+            # Signatures are not saved; rebuild them from every term in the index.
+            for c in self.clusters:
+                self.scorer.index(c, c.terms)
+
+    def save(self, path):
+        state.save_state(path, self.clusters, self.index, self.doc_freqs, self.docnum,
+                         self.cluster_count, self.vocab, consolidated=self.consolidated,
+                         new_clusters=self.counters['new_clusters'], prune_pos=self.prune_pos)
+
+    def stats(self):
+        """ Return current sizes, plus the running totals in counters. """
+        stats = dict(self.counters)
+        stats.update({
+            'lines': self.docnum,
+            'clusters': len(self.clusters),
+            'index_terms': len(self.index),
+            'postings': sum(len(c.terms) for c in self.clusters),
+            'vocabulary': len(self.vocab),
+            'max_candidates': self.max_candidates,
+        })
+        return stats
+
+    def observe(self, doc_freqs, nlines):
+        """ Count nlines lines clustered elsewhere, whose tokens had document
+        frequencies doc_freqs, in this clusterer's document frequencies. """
+        freqs = Counter()
+        for i, v in zip(self.vocab.intern(doc_freqs.keys()), doc_freqs.values()):
+            freqs[i] += v
+        self.docnum += nlines
+        if self.hash_buckets > 0:
+            self.doc_freqs.update(freqs, self.docnum)
+        else:
+            self.doc_freqs.update(freqs)
+
+    def freeze_idfs(self, doc_freqs, docnum):
+        """ From now on, weight terms by the idfs of doc_freqs, the document
+        frequencies of terms over docnum lines, instead of counting the lines
+        assigned. Terms missing from doc_freqs get the idf of a term seen once. """
+        freqs = Counter()
+        # Hashed terms may share an id.
+        for i, v in zip(self.vocab.intern(doc_freqs.keys()), doc_freqs.values()):
+            freqs[i] += v
+        self.idf_table = {t: idf(t, freqs, docnum) for t in freqs}
+        self.default_idf = log10(docnum + 1)
+        if self.hash_buckets > 0:
+            # Undecayed, so the frozen counts are saved as they are.
+            self.doc_freqs = BucketCounts(self.hash_buckets)
+            self.doc_freqs.update(freqs, docnum)
+        else:
+            self.doc_freqs = freqs
+
+    def term_idf(self, t):
+        if self.idf_table is not None:
+            return self.idf_table.get(t, self.default_idf)
+        if self.hash_buckets > 0:
+            table, top, floor = self.doc_freqs.idf_table(self.docnum)
+            return top - max(table[t], floor)
+        return idf(t, self.doc_freqs, self.docnum)
+
+    def consolidate(self):
+        """
+        Merge clusters whose tf-idf centroids have cosine similarity of at
+        least merge_threshold. Each cluster assigned a line since the last
+        consolidation is compared with the clusters found in the index for
+        the top term_filter terms of its centroid, from the largest cluster
+        down. The smaller cluster of a pair is merged into the larger, which
+        keeps its id. Returns the (old id, new id) of each merge, which are
+        also added to remaps.
+        """
+        since = self.consolidated[0]
+        self.consolidated = (self.docnum, self.counters['new_clusters'])
+        vectors, idfs = {}, {}
+
+        def vector(c):
+            v = vectors.get(c)
+            if v is None:
+                weights = c.term_weights
+                for t in weights:
+                    if t not in idfs:
+                        idfs[t] = self.term_idf(t)
+                weights = {t: w * idfs[t] for t, w in weights.items()}
+                v = vectors[c] = (weights, sqrt(sum(w * w for w in weights.values())))
+            return v
+
+        merged = []
+        for c in sorted((c for c in self.clusters if c.updated > since), key=lambda c: (-c.size, c._id)):
+            if len(c.terms) == 0:
+                continue  # merged earlier in this pass
+            weights, norm = vector(c)
+            words = heapq.nlargest(self.term_filter, weights, key=weights.get)
+            for other in search_index(self.index, words, min_match=self.min_match):
+                if other is c or len(other.terms) == 0:
+                    continue
+                other_weights, other_norm = vector(other)
+                dot = sum(w * other_weights.get(t, 0.) for t, w in weights.items())
+                if dot < self.merge_threshold * norm * other_norm:
+                    continue
+                keep, gone = (c, other) if (c.size, other._id) >= (other.size, c._id) else (other, c)
+                self.merge(keep, gone)
+                vectors.pop(keep, None)
+                merged.append((gone._id, keep._id))
+                if gone is c:
+                    break
+        if len(merged) > 0:
+            self.clusters = [c for c in self.clusters if len(c.terms) > 0]
+            self.remaps.extend((self.docnum, old, new) for old, new in merged)
+            self.counters['merged'] += len(merged)
+        return merged
+
+    def merge(self, keep, gone):
+        """ Merge cluster gone into cluster keep, and remove it. As with lines
+        added to a cluster, keep's centroid keeps its own terms. """
+        self.scorer.merge(keep, gone)
+        keep.created = min(keep.created, gone.created)
+        keep.updated = max(keep.updated, gone.updated)
+        if self.max_terms <= 0:
+            update_index(self.index, keep, gone.terms)
+        remove_clusters([gone], self.index, self.scorer)
+
+    def nearest(self, line):
+        """
+        Return (cluster id, score) for the cluster assign would choose for
+        line, without changing any state, or (None, None) if the line would
+        start a new cluster. Returns None if the line has no tokens.
+        Document frequencies count the line, as in assign. Tokens never seen
+        rank among the line's top terms, at the idf assign would give them,
+        but cannot match any cluster; with LSH retrieval, they are left out
+        of the line's signature.
+        """
+        line_tokens = self.tokenizer(line)
+        if len(line_tokens) == 0:
+            return None
+        if self.hash_buckets > 0:
+            counts = self.vocab.count(line_tokens)
+        else:
+            # Unseen tokens are kept as strings, which no cluster holds.
+            ids = self.vocab.ids
+            counts = Counter(ids.get(t, t) for t in line_tokens)
+        tokens = Counter({t: v for t, v in counts.items() if not isinstance(t, str)})
+        docnum = self.docnum + 1
+        if self.idf_table is not None:
+            idfs = {t: self.idf_table.get(t, self.default_idf) for t in counts}
+        elif self.hash_buckets > 0:
+            top = self.doc_freqs.lines(docnum) + 1
+            idfs = {t: log10(top / max(self.doc_freqs.count(t, docnum) + v, 1.)) for t, v in counts.items()}
+        else:
+            idfs = {t: log10((docnum + 1) / (self.doc_freqs.get(t, 0) + v)) for t, v in counts.items()}
+        words = [t for t in sorted(counts, key=lambda x: -idfs[x])[:self.term_filter] if t in tokens]
+        if self.duplicates is not None and len(tokens) == len(counts):
+            hit = self.duplicates.entries.get(self.duplicates.key(tokens))
+            if hit is not None and len(hit.terms) > 0:
+                return hit._id, float(self.scorer.score([hit], tokens, idfs)[0])
+        candidates = self.retrieve(words, tokens if self.retrieval == 'lsh' else counts, idfs)
+        best, score = self.scorer.best(candidates, self.scorer.score(candidates, tokens, idfs), self.threshold)
+        if best is None:
+            return None, None
+        return best._id, float(score)
+
+    def assign(self, line):
+        """
+        Assign a line to a cluster. Returns (cluster id, score), where score is
+        None if the line started a new cluster, or None if the line has no tokens.
+        """
+        return self.assign_batch([line])[0]
+
+    def assign_many(self, lines, batch_size=1):
+        """ Assign each of lines in turn, batch_size at a time, yielding the result of each. """
+        if batch_size < 1:
+            raise ValueError('batch_size must be at least 1')
+        lines = iter(lines)
+        while True:
+            batch = list(islice(lines, batch_size))
+            if len(batch) == 0:
+                break
+            for result in self.assign_batch(batch):
+                yield result
+
+    def assign_batch(self, lines):
+        """ Assign a block of lines, returning the result of each as in assign. """
+        scorer, index, vocab, doc_freqs = self.scorer, self.index, self.vocab, self.doc_freqs
+        counters, idf_table = self.counters, self.idf_table
+        start = time.perf_counter()
+        results = [None] * len(lines)
+        docs = []
+        # Clusters created or updated in this block have updated > first.
+        first = self.docnum
+        for i, line_tokens in enumerate(self.tokenizer.tokenize_many(lines)):
+            self.docnum += 1
+            tokens = vocab.count(line_tokens)
+            if len(tokens) > 0:
+                docs.append((i, self.docnum, tokens))
+                if idf_table is None:
+                    if self.hash_buckets > 0:
+                        doc_freqs.update(tokens, self.docnum)
+                    else:
+                        doc_freqs.update(tokens)
+        idfs = {}
+        if self.hash_buckets > 0 and idf_table is None:
+            table, top, floor = doc_freqs.idf_table(self.docnum)
+            for _, _, tokens in docs:
+                for token in tokens:
+                    if token not in idfs:
+                        idfs[token] = top - max(table[token], floor)
+        else:
+            for _, _, tokens in docs:
+                for token in tokens:
+                    if token not in idfs:
+                        if idf_table is None:
+                            idfs[token] = idf(token, doc_freqs, self.docnum)
+                        else:
+                            idfs[token] = idf_table.get(token, self.default_idf)
         # What are the four words with highest tfidf weight? Use to filter comparisons.
-        top_words = sorted(tokens, key=lambda x: -idfs[x])[:term_filter]  # (doc_freqs[token], token) for token in tokens)
-        best_cluster = None
-        best_score = -1
-        for cluster in search_index(index, top_words, min_match=min_match):
-            nmatch += 1
-            # cluster = clusters[ci]
-            score = cluster.score(tokens, idfs)
-            if score > best_score and score > threshold:
-                best_cluster = cluster
-                best_score = score
-        if not best_cluster:
-            new_cluster = Cluster(cluster_count, tokens)
-            clusters.append(new_cluster)
-            # clusters.append(Cluster(cluster_count, tokens))
-            # update_index(index, cluster_count, tokens)
-            # print('%d\t%s\t-' % (cluster_count, line))
-            update_index(index, new_cluster, tokens)
-            print('%d\t%s\t-' % (new_cluster._id, line))
-            cluster_count += 1
+        top_words = [sorted(tokens, key=lambda x: -idfs[x])[:self.term_filter] for _, _, tokens in docs]
+        tokenized = time.perf_counter()
+        counters['tokenize_sec'] += tokenized - start
+        duplicates = self.duplicates
+        if duplicates is not None:
+            # A repeated line is scored only against its cached cluster.
+            keys = [duplicates.key(tokens) for _, _, tokens in docs]
+            hits = [duplicates.get(key) for key in keys]
+            candidates = [[hit] if hit is not None else self.retrieve(words, tokens, idfs)
+                          for hit, words, (_, _, tokens) in zip(hits, top_words, docs)]
         else:
-            #clusters[best_cluster].add(tokens)
-            best_cluster.add(tokens)
-            update_index(index, best_cluster, tokens)
-            print('%d\t%s\t%g' % (best_cluster._id, line, best_score))
-        if prune_freq != -1 and docnum % prune_freq == 0:
-            clusters, index = prune_clusters(clusters, index)
+            keys = [None] * len(docs)
+            candidates = [self.retrieve(words, tokens, idfs) for words, (_, _, tokens) in zip(top_words, docs)]
+        retrieved = time.perf_counter()
+        counters['retrieve_sec'] += retrieved - tokenized
+        scores = scorer.score_many(list(zip(candidates, [tokens for _, _, tokens in docs])), idfs)
+        # Whether any cluster has been created or updated so far in this block.
+        changed = False
+        batch_index = defaultdict(set)
+        prune = False
+        for (i, n, tokens), key, words, cands, cand_scores in zip(docs, keys, top_words, candidates, scores):
+            best = duplicates.get(key) if duplicates is not None else None
+            if best is not None:
+                if len(cands) == 1 and cands[0] is best and best.updated <= first:
+                    best_score = cand_scores[0]
+                else:
+                    best_score = scorer.score([best], tokens, idfs)[0]
+                counters['duplicates'] += 1
+            else:
+                # Rescore candidates changed earlier in the block, and score
+                # clusters it created, in a single call.
+                stale = [j for j, c in enumerate(cands) if c.updated > first] if changed else []
+                new_cands = search_index(batch_index, words, min_match=self.min_match) if batch_index else []
+                if len(stale) > 0 or len(new_cands) > 0:
+                    rescored = scorer.score([cands[j] for j in stale] + new_cands, tokens, idfs)
+                if len(stale) > 0:
+                    cand_scores = cand_scores.copy()
+                    for j, score in zip(stale, rescored):
+                        cand_scores[j] = score
+                best, best_score = scorer.best(cands, cand_scores, self.threshold)
+                if len(new_cands) > 0:
+                    new_best, new_score = scorer.best(new_cands, rescored[len(stale):], self.threshold)
+                    if new_score > best_score:
+                        best, best_score = new_best, new_score
+                ncandidates = len(cands) + len(new_cands)
+                counters['candidates'] += ncandidates
+                self.max_candidates = max(self.max_candidates, ncandidates)
+            if not best:
+                if self.max_terms > 0 and len(tokens) > self.max_terms:
+                    top = set(heapq.nlargest(self.max_terms, tokens, key=lambda t: tokens[t] * idfs[t]))
+                    terms = {t: v for t, v in tokens.items() if t in top}
+                    new_cluster = scorer.restore(self.cluster_count, 1, sum(tokens.values()), terms)
+                else:
+                    terms = tokens
+                    new_cluster = scorer.new_cluster(self.cluster_count, tokens)
+                new_cluster.created = n
+                new_cluster.updated = n
+                self.clusters.append(new_cluster)
+                update_index(index, new_cluster, terms)
+                # Not update_index, which would record the terms in
+                # new_cluster.terms a second time.
+                for t in terms:
+                    batch_index[t].add(new_cluster)
+                changed = True
+                results[i] = (new_cluster._id, None)
+                self.cluster_count += 1
+                counters['new_clusters'] += 1
+                best = new_cluster
+            else:
+                scorer.add(best, tokens)
+                best.updated = n
+                if self.max_terms <= 0:
+                    update_index(index, best, tokens)
+                changed = True
+                results[i] = (best._id, float(best_score))
+            if duplicates is not None:
+                duplicates.put(key, best)
+            if self.prune_freq != -1 and n % self.prune_freq == 0:
+                prune = True
+        counters['docs'] += len(docs)
+        scored = time.perf_counter()
+        counters['score_sec'] += scored - retrieved
+        self.maintain(len(lines), len(docs), prune)
+        counters['prune_sec'] += time.perf_counter() - scored
+        return results
+
+    def retrieve(self, words, tokens, idfs):
+        """ Return candidate clusters for a line with top words words. """
+        if self.retrieval == 'exhaustive':
+            return search_index(self.index, words, min_match=self.min_match)
+        if self.retrieval == 'lsh':
+            return self.scorer.candidates(tokens)
+        if max(v * idfs[t] for t, v in tokens.items()) <= self.threshold:
+            return []
+        return search_index_pruned(self.index, words, self.min_match, self.top_postings, self.docnum)
+
+    def maintain(self, nlines, ndocs, prune):
+        """ Consolidate, prune and evict clusters after a block of nlines lines, ndocs of them with tokens. """
+        every, new_clusters = self.consolidate_every, self.consolidate_clusters
+        if (every > 0 and self.docnum // every > (self.docnum - nlines) // every) or \
+                (new_clusters > 0 and self.counters['new_clusters'] - self.consolidated[1] >= new_clusters):
+            self.consolidate()
+        if self.prune_freq != -1 and self.prune_incremental:
+            count = int(-(-len(self.clusters) * ndocs // self.prune_freq))
+            self.prune_pos = prune_step(self.clusters, self.index, self.prune_pos, count, n=self.min_size,
+                                        created_before=self.docnum - self.prune_freq, scorer=self.scorer)
+        elif prune:
+            self.clusters, self.index = prune_clusters(self.clusters, self.index, n=self.min_size,
+                                                       scorer=self.scorer)
+        if self.max_clusters > 0 and len(self.clusters) > self.max_clusters:
+            self.clusters, self.index = evict_clusters(self.clusters, self.index,
+                                                       len(self.clusters) - int(.9 * self.max_clusters),
+                                                       self.eviction, self.docnum, self.scorer)
+        if self.max_memory > 0 and \
+                self.docnum // MEMORY_CHECK_LINES > (self.docnum - nlines) // MEMORY_CHECK_LINES:
+            usage = memory_usage(self.clusters, self.doc_freqs)
+            if usage > self.max_memory * 1e6:
+                count = int(len(self.clusters) * (1 - .9 * self.max_memory * 1e6 / usage)) + 1
+                self.clusters, self.index = evict_clusters(self.clusters, self.index, count,
+                                                           self.eviction, self.docnum, self.scorer)
+                if self.idf_table is None and self.hash_buckets <= 0:
+                    forget_rare_terms(self.doc_freqs, self.index, self.vocab)
+
+
+def interval_stats(current, previous, seconds):
+    """
+    Summarize the stats of a Clusterer over an interval, given stats() at
+    its end and start and its length in seconds.
+    """
+    delta = lambda k: current.get(k, 0) - previous.get(k, 0)
+    docs = max(1, delta('docs'))
+    report = {k: current[k] for k in ['lines', 'clusters', 'index_terms', 'postings', 'vocabulary',
+                                      'max_candidates']}
+    report.update({
+        'lines_per_sec': delta('lines') / seconds if seconds > 0 else 0.,
+        'mean_candidates': delta('candidates') / docs,
+        'new_cluster_fraction': delta('new_clusters') / docs,
+    })
+    for stage in ['tokenize', 'retrieve', 'score', 'prune', 'output']:
+        report[stage + '_sec'] = delta(stage + '_sec')
+    # From the threads of --io-threads, if any.
+    for side in ['read', 'write']:
+        if side + '_queue' in current:
+            report[side + '_queue'] = current[side + '_queue']
+            report[side + '_wait_sec'] = delta(side + '_wait_sec')
+    return report
+
+
+def run(threshold, prune_freq, min_match, term_filter, engine='dict', batch_size=1,
+        load_state=None, save_state=None, checkpoint_every=-1, min_size=3, prune_incremental=False,
+        max_clusters=-1, max_memory=-1, eviction='lru', flush='line', stats_every=-1, stats_file=None,
+        retrieval='exhaustive', max_postings=-1, lsh_bands=32, lsh_rows=2, duplicate_cache=-1,
+        workers=1, exchange_every=1000, fmt='text', summarize=-1, summarize_clusters=10, summarize_docs=3,
+        serve=None, batch_wait=2., offline=None, idf_table=None, reassign=False, max_terms=-1,
+        consolidate_every=-1, consolidate_clusters=-1, merge_threshold=.5, remap_file=None,
+        hash_buckets=-1, df_half_life=-1, token_pattern=r'\w+', normalize=None, stopwords=None,
+        io_threads=False, read_ahead=1, offsets=False, files=()):
+    """
+    Cluster stdin with a Clusterer, batch_size lines at a time, and print
+    the cluster id, line and score of each line in format fmt (see
+    sclust.records). If summarize is positive, instead feed them to a
+    sclust_summarize.Summarizer, which prints the top summarize_clusters
+    clusters every summarize lines.
+
+    With more than one worker, lines are sharded across worker processes,
+    which exchange document frequencies every exchange_every lines (see
+    sclust.parallel).
+
+    Every stats_every lines, write a JSON line of interval_stats to
+    stats_file, or to stderr.
+
+    If load_state is given, resume from that snapshot. If save_state is given,
+    write a snapshot there at the end of input and every checkpoint_every lines.
+
+    Output is flushed according to the flush policy (see sclust.output).
+
+    If serve is given, answer requests on that address instead of reading
+    stdin (see sclust.server), gathering requests for up to batch_wait
+    milliseconds into micro-batches.
+
+    If offline is given, cluster that file instead of stdin with global
+    idfs, read from or saved to idf_table, and with reassign, reassign its
+    lines to the final clusters (see sclust.offline). workers processes
+    count document frequencies and reassign lines.
+
+    When clusters are merged (see Clusterer.consolidate), the line number,
+    old id and new id of each merge are written to remap_file, or to stderr.
+
+    Lines are split into tokens matching token_pattern, after the
+    comma-separated normalizers in normalize, and without stopwords (see
+    sclust.tokenizer.build_tokenizer).
+
+    Input lines are read from files in turn (see sclust.streams.FileReader),
+    or from stdin if there are none. With offsets, each line's text is
+    written as path:line number. With io_threads, input is read and output
+    written on background threads, and read_ahead files are read ahead.
+    """
+    if batch_size < 1:
+        raise ValueError('--batch-size must be at least 1')
+    stdout = sys.stdout if fmt != 'binary' else getattr(sys.stdout, 'buffer', sys.stdout)
+    reader = writer = None
+    if io_threads:
+        stdout = writer = BackgroundStream(stdout)
+    if summarize > 0:
+        out = Summarizer(summarize, summarize_clusters, summarize_docs, flush, fmt=fmt, stream=stdout)
+    else:
+        out = AssignmentWriter(fmt, flush, stdout)
+    clusterer_kwargs = dict(
+        threshold=threshold, prune_freq=prune_freq, min_match=min_match, term_filter=term_filter,
+        engine=engine, min_size=min_size, prune_incremental=prune_incremental, max_clusters=max_clusters,
+        max_memory=max_memory, eviction=eviction, retrieval=retrieval, max_postings=max_postings,
+        lsh_bands=lsh_bands, lsh_rows=lsh_rows, duplicate_cache=duplicate_cache, max_terms=max_terms,
+        consolidate_every=consolidate_every, consolidate_clusters=consolidate_clusters,
+        merge_threshold=merge_threshold, hash_buckets=hash_buckets, df_half_life=df_half_life,
+        tokenizer=build_tokenizer(token_pattern, normalize, stopwords))
+    remap_out = open(remap_file, 'a') if remap_file else sys.stderr
+
+    def close_output():
+        out.close()
+        if writer is not None:
+            writer.close()
+
+    def sync_output():
+        """ Flush output and wait until it is written. """
+        out.flush()
+        if writer is not None:
+            writer.wait()
+
+    def open_input():
+        """ Return an iterator over the stripped input lines, or with
+        offsets, (path:line number, line) pairs. """
+        nonlocal reader
+        reader = FileReader(files or ['-'], io_threads, read_ahead)
+        return reader.positions() if offsets else iter(reader)
+
+    if files and (offline or serve):
+        raise ValueError('input files cannot be combined with --offline or --serve')
+    if offline:
+        if load_state or stats_every > 0 or serve or io_threads or offsets:
+            raise ValueError('--offline cannot be combined with --load-state, --stats-every, --serve, '
+                             '--io-threads or --offsets')
+        from .offline import run_offline
+        clusterer = Clusterer(**clusterer_kwargs)
+        run_offline(clusterer, offline, out, workers, batch_size, idf_table, reassign)
+        close_output()
+        write_remaps(clusterer, remap_out)
+        if remap_file:
+            remap_out.close()
+        if save_state:
+            clusterer.save(save_state)
+        return
+    if workers > 1:
+        if load_state or save_state or stats_every > 0 or consolidate_every > 0 or consolidate_clusters > 0 \
+                or io_threads or offsets or serve:
+            # Worker processes are forked, which is unsafe with I/O threads running.
+            raise ValueError('--workers cannot be combined with --load-state, --save-state, --stats-every, '
+                             'consolidation, --io-threads, --offsets or --serve')
+        from .parallel import run_sharded
+        run_sharded(clusterer_kwargs, workers, out, batch_size, exchange_every, open_input())
+        close_output()
+        return
+    clusterer = Clusterer(**clusterer_kwargs)
+    if load_state:
+        clusterer.load(load_state)
+    if serve:
+        from .server import serve as serve_clusterer
+        serve_clusterer(clusterer, serve, batch_size, batch_wait / 1000., save_state, checkpoint_every)
+        return
+    stats_out = open(stats_file, 'a') if stats_file else sys.stderr
+    lines_in = open_input()
+    last_stats, last_time = clusterer.stats(), time.time()
+    while True:
+        lines = list(islice(lines_in, batch_size))
+        if len(lines) == 0:
+            break
+        texts = lines
+        if offsets:
+            texts, lines = zip(*lines)
+        results = clusterer.assign_batch(lines)
+        start = time.perf_counter()
+        for text, result in zip(texts, results):
+            if result is None:
+                continue
+            out.write(result[0], text, result[1])
+        if clusterer.remaps:
+            sync_output()
+            write_remaps(clusterer, remap_out)
+        clusterer.counters['output_sec'] += time.perf_counter() - start
+        docnum = clusterer.docnum
+        if stats_every > 0 and docnum // stats_every > (docnum - len(lines)) // stats_every:
+            stats, now = clusterer.stats(), time.time()
+            if io_threads:
+                stats.update(reader.stats())
+                stats.update(writer.stats())
+            stats_out.write(json.dumps(interval_stats(stats, last_stats, now - last_time)) + '\n')
+            stats_out.flush()
+            last_stats, last_time = stats, now
+            clusterer.max_candidates = 0
+        if save_state and checkpoint_every > 0 and \
+                docnum // checkpoint_every > (docnum - len(lines)) // checkpoint_every:
+            sync_output()
+            clusterer.save(save_state)
+    close_output()
+    if stats_file:
+        stats_out.close()
+    if remap_file:
+        remap_out.close()
+    if save_state:
+        clusterer.save(save_state)
+
 
-        # print('avg num clusters searched per doc=%.1f' % (nmatch / docnum))
-        sys.stdout.flush()
+def write_remaps(clusterer, out):
+    """ Write and clear the remaps of clusterer. """
+    for remap in clusterer.remaps:
+        out.write('%d\t%d\t%d\n' % remap)
+    out.flush()
+    del clusterer.remaps[:]
 
 
 # Weirdness when piping to unix tools. See http://stackoverflow.com/a/26736013/1756896
@@ -141,11 +1138,54 @@ def _void_f(*args,**kwargs):
 def main():
     args = docopt(__doc__)
     try:
-        run(float(args['--threshold']),
-            float(args['--prune-frequency']),
-            int(args['--min-match']),
-            int(args['--term-filter']))
-    except (BrokenPipeError, IOError):
+        run(threshold=float(args['--threshold']),
+            prune_freq=float(args['--prune-frequency']),
+            min_match=int(args['--min-match']),
+            term_filter=int(args['--term-filter']),
+            engine=args['--engine'],
+            batch_size=int(args['--batch-size']),
+            load_state=args['--load-state'],
+            save_state=args['--save-state'],
+            checkpoint_every=int(args['--checkpoint-every']),
+            min_size=int(args['--min-size']),
+            prune_incremental=args['--prune-incremental'],
+            max_clusters=int(args['--max-clusters']),
+            max_memory=float(args['--max-memory']),
+            eviction=args['--eviction'],
+            flush=args['--flush'],
+            stats_every=int(args['--stats-every']),
+            stats_file=args['--stats-file'],
+            retrieval=args['--retrieval'],
+            max_postings=int(args['--max-postings']),
+            lsh_bands=int(args['--lsh-bands']),
+            lsh_rows=int(args['--lsh-rows']),
+            duplicate_cache=int(args['--duplicate-cache']),
+            workers=int(args['--workers']),
+            exchange_every=int(args['--exchange-every']),
+            fmt=args['--format'],
+            summarize=int(args['--summarize']),
+            summarize_clusters=int(args['--summarize-clusters']),
+            summarize_docs=int(args['--summarize-docs']),
+            serve=args['--serve'],
+            batch_wait=float(args['--batch-wait']),
+            offline=args['--offline'],
+            idf_table=args['--idf-table'],
+            reassign=args['--reassign'],
+            max_terms=int(args['--max-terms']),
+            consolidate_every=int(args['--consolidate-every']),
+            consolidate_clusters=int(args['--consolidate-clusters']),
+            merge_threshold=float(args['--merge-threshold']),
+            remap_file=args['--remap-file'],
+            hash_buckets=int(args['--hash-buckets']),
+            df_half_life=float(args['--df-half-life']),
+            token_pattern=args['--token-pattern'],
+            normalize=args['--normalize'],
+            stopwords=args['--stopwords'],
+            io_threads=args['--io-threads'],
+            read_ahead=int(args['--read-ahead']),
+            offsets=args['--offsets'],
+            files=args['<file>'])
+    except BrokenPipeError:
         sys.stdout.write = _void_f
         sys.stdout.flush = _void_f
         sys.exit()
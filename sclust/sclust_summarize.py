@@ -3,43 +3,306 @@
 E.g., cat data.txt | sclust | sclust-summarize
 
 usage:
-    sclust-summarize [--help --frequency <F> --num-docs-to-print <N> --num-clusters-to-print <K>]
+    sclust-summarize [--help --frequency <F> --num-docs-to-print <N> --num-clusters-to-print <K> --flush <P> --capacity <M> --window <N> --half-life <H> --input-format <F> --format <F>] [<file>...]
 
 Options
     -h, --help
     -f, --frequency <F>               Print clusters every F lines [default: 1000]
     -n, --num-clusters-to-print <N>   Number of top clusters to print [default: 10]
     -k, --num-docs-to-print <K>       Number of documents per cluster to print [default: 3]
+    --flush <P>                       When to flush output: line (after every summary), eof, every N summaries, or every T milliseconds (e.g. 500ms). [default: line]
+    -m, --capacity <M>                Count clusters approximately in M counters (Space-Saving), keeping documents only for those clusters, instead of counting every cluster. Counts may be overestimated by up to lines / M. [default: -1]
+    -w, --window <N>                  Rank clusters by their counts over the last N lines only. [default: -1]
+    -l, --half-life <H>               Rank clusters by counts that decay by half every H lines. [default: -1]
+    --input-format <F>                Format of the sclust output read: text, json or binary (see sclust.records). [default: text]
+    --format <F>                      Format of the summaries written: text, json or binary. [default: text]
+
+sclust output is read from the files given, in turn, or from stdin if none are (- also means stdin). gzip, bz2 and xz files are decompressed as they are read.
 """
 from collections import Counter, defaultdict, deque
 from docopt import docopt
-from math import sqrt, log10
-import numpy as np
-import re
+import heapq
+import io
 import sys
 
-def print_summary(cluster_counts, clusterid2lines, num_clusters, lineno):
-    print('\n---------%d documents, %d clusters---------\n' % (lineno, len(cluster_counts)))
-    for clusterid, count in cluster_counts.most_common(num_clusters):
-        lines = clusterid2lines[clusterid]
-        print('%d\t%s' % (count, lines[0]))
-        for line in list(lines)[1:]:
-            print(' \t \t%s' % '\t'.join(line.split('\t')[1:]))
-    sys.stdout.flush()
-
-def run(frequency, num_clusters, num_docs):
-    cluster_counts = Counter()
-    clusterid2lines = defaultdict(lambda: deque(maxlen=num_docs))
-    lineno = 0
-    for line in sys.stdin:
-        line = line.strip()
-        lineno += 1
-        fields = line.split('\t')
-        cluster_counts[fields[0]] += 1
-        clusterid2lines[fields[0]].append(line)
-        if lineno % frequency == 0:
-            print_summary(cluster_counts, clusterid2lines, num_clusters, lineno)
-    print_summary(cluster_counts, clusterid2lines, num_clusters, lineno)
+from . import records
+from .output import Writer
+from .streams import open_file
+
+class SpaceSaving:
+    """
+    Approximate counts of the most frequent keys of a stream in at most
+    capacity counters (Metwally et al., 2005). When all counters are taken, a
+    new key replaces a key with the smallest count and inherits that count,
+    so counts are overestimated by at most the stream length / capacity.
+    Keys with the same count are kept in buckets, oldest first, so each
+    update is O(1).
+
+    >>> s = SpaceSaving(2)
+    >>> for key in 'aabac':
+    ...     dropped = s.add(key)
+    >>> dropped
+    ['b']
+    >>> s.most_common(2)
+    [('a', 3), ('c', 2)]
+    """
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.counts = {}
+        self.buckets = defaultdict(dict)
+        self.min_count = 0
+
+    def __len__(self):
+        return len(self.counts)
+
+    def add(self, key):
+        """ Count one occurrence of key. Returns the keys no longer counted. """
+        dropped = []
+        count = self.counts.get(key)
+        if count is None:
+            if len(self.counts) < self.capacity:
+                count = 0
+            else:
+                count = self.min_count
+                evicted = next(iter(self.buckets[count]))
+                self._take(evicted, count)
+                del self.counts[evicted]
+                dropped.append(evicted)
+        else:
+            self._take(key, count)
+        self.counts[key] = count + 1
+        self.buckets[count + 1][key] = None
+        if count == 0 or (count == self.min_count and count not in self.buckets):
+            self.min_count = count + 1
+        return dropped
+
+    def _take(self, key, count):
+        bucket = self.buckets[count]
+        del bucket[key]
+        if len(bucket) == 0:
+            del self.buckets[count]
+
+    def most_common(self, n):
+        """ Return the n keys with the highest counts, with their counts. Ties
+        go to the key counted first, as in Counter.most_common. """
+        return heapq.nlargest(n, self.counts.items(), key=lambda x: x[1])
+
+
+class SlidingWindow:
+    """
+    Counts of the keys among the last size keys of a stream.
+
+    >>> w = SlidingWindow(3)
+    >>> [w.add(key) for key in 'aabcc']
+    [[], [], [], [], ['a']]
+    >>> w.most_common(2)
+    [('c', 2), ('b', 1)]
+    """
+    def __init__(self, size):
+        self.size = size
+        self.window = deque()
+        self.counts = Counter()
+
+    def __len__(self):
+        return len(self.counts)
+
+    def add(self, key):
+        """ Count key, forgetting the key that leaves the window. Returns the
+        keys no longer counted. """
+        self.window.append(key)
+        self.counts[key] += 1
+        if len(self.window) > self.size:
+            old = self.window.popleft()
+            self.counts[old] -= 1
+            if self.counts[old] == 0:
+                del self.counts[old]
+                return [old]
+        return []
+
+    def most_common(self, n):
+        return self.counts.most_common(n)
+
+
+# Decayed counts below this are dropped.
+MIN_DECAYED_COUNT = .1
+
+
+class DecayedCounts:
+    """
+    Counts of the keys of a stream where each occurrence counts half as much
+    every half_life keys. Rather than decaying every count on every key, the
+    t-th key adds 2 ** (t / half_life), which ranks keys the same way. Once
+    every half_life keys, counts are rescaled to the present, and keys
+    whose count fell below MIN_DECAYED_COUNT are dropped.
+
+    >>> d = DecayedCounts(2)
+    >>> [d.add(key) for key in 'aabbbbbb']
+    [[], [], [], [], [], [], [], []]
+    >>> d.most_common(2)  # doctest: +ELLIPSIS
+    [('b', 2.98...), ('a', 0.21...)]
+    >>> [d.add(key) for key in 'bbbb']
+    [[], [], [], ['a']]
+    """
+    def __init__(self, half_life):
+        self.half_life = half_life
+        self.interval = max(1, int(half_life))
+        self.counts = {}
+        self.time = 0
+        self.base = 0
+
+    def __len__(self):
+        return len(self.counts)
+
+    def add(self, key):
+        """ Count key. Returns the keys dropped for being too rare. """
+        self.time += 1
+        self.counts[key] = self.counts.get(key, 0.) + 2 ** ((self.time - self.base) / self.half_life)
+        if self.time - self.base < self.interval:
+            return []
+        scale = 2 ** (-(self.time - self.base) / self.half_life)
+        dropped = []
+        for k, count in self.counts.items():
+            count *= scale
+            self.counts[k] = count
+            if count < MIN_DECAYED_COUNT:
+                dropped.append(k)
+        for k in dropped:
+            del self.counts[k]
+        self.base = self.time
+        return dropped
+
+    def most_common(self, n):
+        """ Return the n keys with the highest decayed counts, with those counts. """
+        scale = 2 ** (-(self.time - self.base) / self.half_life)
+        return [(k, count * scale) for k, count in heapq.nlargest(n, self.counts.items(), key=lambda x: x[1])]
+
+
+def _score(score):
+    if score is None:
+        return '-'
+    return '%g' % score if isinstance(score, float) else str(score)
+
+
+def print_summary(cluster_counts, clusterid2lines, num_clusters, lineno, out=None, nclusters=None,
+                  fmt='text'):
+    """
+    Write one summary as a single record to out, a sclust.output.Writer
+    (by default one that flushes every record). clusterid2lines maps each
+    cluster to its recent (line, score) pairs. nclusters is the number of
+    clusters to report, by default the size of cluster_counts.
+    """
+    if out is None:
+        out = Writer()
+    if nclusters is None:
+        nclusters = len(cluster_counts)
+    top = cluster_counts.most_common(num_clusters)
+    if fmt != 'text':
+        out.write(records.format_summary(fmt, {
+            'documents': lineno,
+            'clusters': nclusters,
+            'top': [{'cluster': clusterid, 'count': count,
+                     'docs': [{'text': line, 'score': score} for line, score in clusterid2lines[clusterid]]}
+                    for clusterid, count in top]}))
+        return
+    text = ['\n---------%d documents, %d clusters---------\n\n' % (lineno, nclusters)]
+    for clusterid, count in top:
+        lines = list(clusterid2lines[clusterid])
+        count = '%.1f' % count if isinstance(count, float) else '%d' % count
+        text.append('%s\t%s\t%s\t%s\n' % (count, clusterid, lines[0][0], _score(lines[0][1])))
+        for line, score in lines[1:]:
+            text.append(' \t \t%s\t%s\n' % (line, _score(score)))
+    out.write(''.join(text))
+
+
+class Summarizer:
+    """
+    Count the lines assigned to each cluster, and write a summary of the top
+    clusters every frequency lines and when closed. Clusters are ranked by
+    all-time counts, unless one of these is positive:
+
+    capacity   count approximately with a SpaceSaving of that capacity. The
+               number of clusters reported is the number of lines that
+               started one.
+    window     count over a SlidingWindow of that many lines
+    half_life  count with DecayedCounts of that half-life, in lines
+
+    Documents are kept only for clusters that are still counted.
+
+    >>> import io
+    >>> s = Summarizer(frequency=2, num_clusters=1, fmt='json', stream=io.StringIO())
+    >>> s.write(0, 'hi there', None)
+    >>> s.write(0, 'hi there', .5)
+    >>> s.out.stream.getvalue()  # doctest: +ELLIPSIS
+    '{"documents": 2, "clusters": 1, "top": [{"cluster": 0, "count": 2, "docs": [...]}]}\\n'
+    """
+    def __init__(self, frequency=1000, num_clusters=10, num_docs=3, flush='line', capacity=-1, window=-1,
+                 half_life=-1, fmt='text', stream=None):
+        if sum(x > 0 for x in (capacity, window, half_life)) > 1:
+            raise ValueError('use only one of --capacity, --window and --half-life')
+        self.frequency = frequency
+        self.num_clusters = num_clusters
+        self.fmt = records.check_format(fmt)
+        self.out = Writer(flush, stream)
+        self.clusterid2lines = defaultdict(lambda: deque(maxlen=num_docs))
+        if capacity > 0:
+            self.cluster_counts = SpaceSaving(capacity)
+        elif window > 0:
+            self.cluster_counts = SlidingWindow(window)
+        elif half_life > 0:
+            self.cluster_counts = DecayedCounts(half_life)
+        else:
+            self.cluster_counts = Counter()
+        self.nclusters = 0 if capacity > 0 else None
+        self.lineno = 0
+
+    def write(self, cluster_id, line, score):
+        """ Count a line assigned to cluster_id with score (None if it started the cluster). """
+        self.lineno += 1
+        if isinstance(self.cluster_counts, Counter):
+            self.cluster_counts[cluster_id] += 1
+        else:
+            for clusterid in self.cluster_counts.add(cluster_id):
+                del self.clusterid2lines[clusterid]
+            if self.nclusters is not None:
+                self.nclusters += score is None
+        self.clusterid2lines[cluster_id].append((line, score))
+        if self.lineno % self.frequency == 0:
+            self.summarize()
+
+    def summarize(self):
+        print_summary(self.cluster_counts, self.clusterid2lines, self.num_clusters, self.lineno, self.out,
+                      self.nclusters, self.fmt)
+
+    def flush(self):
+        self.out.flush()
+
+    def close(self):
+        self.summarize()
+        self.out.close()
+
+
+def run(frequency, num_clusters, num_docs, flush='line', capacity=-1, window=-1, half_life=-1,
+        input_format='text', output_format='text', files=()):
+    """
+    Summarize sclust output, in input_format, in files or on stdin every
+    frequency lines (see Summarizer), writing summaries in output_format.
+    """
+    binary = records.check_format(input_format) == 'binary'
+    stdout = sys.stdout if output_format != 'binary' else getattr(sys.stdout, 'buffer', sys.stdout)
+    summarizer = Summarizer(frequency, num_clusters, num_docs, flush, capacity, window, half_life,
+                            output_format, stdout)
+    for path in files or ['-']:
+        if path == '-':
+            stream = sys.stdin if not binary else getattr(sys.stdin, 'buffer', sys.stdin)
+        else:
+            stream = open_file(path)
+            if not binary:
+                stream = io.TextIOWrapper(stream, 'utf-8', 'replace')
+        for cluster_id, line, score in records.read_assignments(input_format, stream):
+            summarizer.write(cluster_id, line, score)
+        if path != '-':
+            stream.close()
+    summarizer.close()
 
 
 # Weirdness when piping to unix tools. See http://stackoverflow.com/a/26736013/1756896
@@ -50,8 +313,10 @@ def main():
     args = docopt(__doc__)
     try:
         run(int(args['--frequency']), int(args['--num-clusters-to-print']),
-            int(args['--num-docs-to-print']))
-    except (BrokenPipeError, IOError):
+            int(args['--num-docs-to-print']), args['--flush'], int(args['--capacity']),
+            int(args['--window']), float(args['--half-life']), args['--input-format'], args['--format'],
+            args['<file>'])
+    except BrokenPipeError:
         sys.stdout.write = _void_f
         sys.stdout.flush = _void_f
         sys.exit()
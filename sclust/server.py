@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+"""Serve a Clusterer over a local socket, keeping its state in memory
+between requests.
+
+Clients send one JSON object per line and get one JSON object per line
+back:
+
+    {"op": "assign", "text": "i like to sing"}  ->  {"cluster": 2, "score": 0.53}
+    {"op": "query", "text": "i like to sing"}   ->  {"cluster": 2, "score": 0.53}
+    {"op": "stats"}                             ->  Clusterer.stats()
+
+assign clusters the line as sclust would. query returns the cluster assign
+would pick without changing any state; its cluster is null if the line would
+start a new cluster. score is null for a line that started a cluster, and
+both are null for a line with no tokens. Any "id" in a request is copied to
+its response. A request that is not a JSON object, whose "text" is not a
+string, or that fails gets {"error": ...} instead, and the server carries
+on. If clusters were merged (see Clusterer.consolidate) while assigning, the
+last response of the consecutive assigns processed together has "merged": a
+list of [old id, new id] pairs.
+
+Ordering: requests are applied in the order the server reads them,
+across all connections, so a query sees every assign read before it.
+Each connection gets its responses in the order of its requests.
+
+Requests that arrive while a batch is being processed, or within
+batch_wait seconds of the first request, form the next micro-batch.
+Consecutive assigns in a micro-batch are clustered with
+Clusterer.assign_many, batch_size lines at a time. Clustering runs on the
+event loop, so one batch is processed at a time.
+
+On SIGINT or SIGTERM the server stops accepting connections, answers the
+requests it has read, and saves state if a save path was given.
+"""
+import asyncio
+import json
+import signal
+
+
+class Server:
+    def __init__(self, clusterer, batch_size=1, batch_wait=.002, save_state=None, checkpoint_every=-1):
+        self.clusterer = clusterer
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        self.save_state = save_state
+        self.checkpoint_every = checkpoint_every
+        self.loop = None
+        self.queue = None
+        self.stopping = None
+        self.connections = set()
+
+    async def serve(self, address):
+        """ Serve on address, either unix:PATH or HOST:PORT, until shutdown. """
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue()
+        self.stopping = asyncio.Event()
+        if address.startswith('unix:'):
+            server = await asyncio.start_unix_server(self.handle, address[len('unix:'):])
+        else:
+            host, port = address.rsplit(':', 1)
+            server = await asyncio.start_server(self.handle, host, int(port))
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                self.loop.add_signal_handler(sig, self.shutdown)
+            except (NotImplementedError, RuntimeError, ValueError):
+                pass  # not in the main thread
+        batcher = asyncio.ensure_future(self.batcher())
+        await self.stopping.wait()
+        server.close()
+        # Let the batcher answer what was already read, then stop it.
+        await self.queue.put(None)
+        await batcher
+        for task in list(self.connections):
+            task.cancel()
+        await asyncio.gather(*self.connections, return_exceptions=True)
+        await server.wait_closed()
+        if self.save_state:
+            self.clusterer.save(self.save_state)
+
+    def shutdown(self):
+        self.stopping.set()
+
+    async def handle(self, reader, writer):
+        """ Read requests from one connection, writing responses in order. """
+        responses = asyncio.Queue()
+
+        async def respond():
+            while True:
+                future = await responses.get()
+                if future is None:
+                    break
+                writer.write((json.dumps(await future) + '\n').encode('utf-8'))
+                await writer.drain()
+
+        responder = asyncio.ensure_future(respond())
+        self.connections.add(asyncio.current_task())
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                future = self.loop.create_future()
+                try:
+                    request = json.loads(line.decode('utf-8'))
+                except ValueError:
+                    future.set_result({'error': 'invalid JSON'})
+                else:
+                    error = check_request(request)
+                    if error is not None:
+                        future.set_result({'error': error})
+                    elif self.stopping.is_set():
+                        future.set_result({'error': 'shutting down'})
+                    else:
+                        self.queue.put_nowait((request, future))
+                responses.put_nowait(future)
+        finally:
+            self.connections.discard(asyncio.current_task())
+            responses.put_nowait(None)
+            await responder
+            writer.close()
+
+    async def batcher(self):
+        """ Collect requests into micro-batches and process them. """
+        while True:
+            item = await self.queue.get()
+            if item is None:
+                return
+            batch = [item]
+            if self.batch_wait > 0:
+                await asyncio.sleep(self.batch_wait)
+            done = False
+            while not self.queue.empty():
+                item = self.queue.get_nowait()
+                if item is None:
+                    done = True
+                    break
+                batch.append(item)
+            self.process(batch)
+            if done:
+                return
+
+    def process(self, batch):
+        """ Answer a micro-batch of (request, future) pairs in order. """
+        start = 0
+        while start < len(batch):
+            end = start + 1
+            if batch[start][0].get('op') == 'assign':
+                while end < len(batch) and batch[end][0].get('op') == 'assign':
+                    end += 1
+            try:
+                self.process_op(batch[start:end])
+            except Exception as e:
+                for _, future in batch[start:end]:
+                    if not future.done():
+                        future.set_result({'error': '%s: %s' % (type(e).__name__, e)})
+            start = end
+
+    def process_op(self, batch):
+        """ Answer consecutive assigns, or a single request of another op. """
+        clusterer = self.clusterer
+        request, future = batch[0]
+        op = request.get('op')
+        if op == 'assign':
+            docnum = clusterer.docnum
+            results = list(clusterer.assign_many([r.get('text', '') for r, _ in batch], self.batch_size))
+            merged = [[old, new] for _, old, new in clusterer.remaps]
+            del clusterer.remaps[:]
+            for j, ((request, future), result) in enumerate(zip(batch, results)):
+                self.reply(request, future, result, merged if merged and j == len(batch) - 1 else None)
+            every = self.checkpoint_every
+            if self.save_state and every > 0 and clusterer.docnum // every > docnum // every:
+                clusterer.save(self.save_state)
+        elif op == 'query':
+            self.reply(request, future, clusterer.nearest(request.get('text', '')))
+        elif op == 'stats':
+            future.set_result(clusterer.stats())
+        else:
+            future.set_result({'error': 'unknown op %s' % op})
+
+    def reply(self, request, future, result, merged=None):
+        cluster_id, score = result if result is not None else (None, None)
+        response = {'cluster': cluster_id, 'score': score}
+        if merged:
+            response['merged'] = merged
+        if 'id' in request:
+            response['id'] = request['id']
+        future.set_result(response)
+
+
+def check_request(request):
+    """
+    Return why request cannot be processed, or None if it can.
+
+    >>> check_request([1, 2])
+    'request must be a JSON object'
+    >>> check_request({'op': 'assign', 'text': 5})
+    'text must be a string'
+    """
+    if not isinstance(request, dict):
+        return 'request must be a JSON object'
+    if not isinstance(request.get('text', ''), str):
+        return 'text must be a string'
+    return None
+
+
+def serve(clusterer, address, batch_size=1, batch_wait=.002, save_state=None, checkpoint_every=-1):
+    """ Run a Server for clusterer on address until it is shut down. """
+    asyncio.run(Server(clusterer, batch_size, batch_wait, save_state, checkpoint_every).serve(address))
@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+"""Save and load the full state of sclust (clusters, inverted index and
+document frequencies) so a stream can be resumed after a restart.
+
+The snapshot is a single binary file:
+
+    magic (8 bytes) | version (uint32) | header length (uint64) | JSON header | arrays
+
+The JSON header holds the scalar state and the dtype, shape and offset of
+each array. Arrays are stored raw, aligned to 64 bytes, and read back with
+np.memmap, so loading does not parse anything but the header.
+"""
+from collections import Counter, defaultdict
+import json
+import numpy as np
+import os
+import struct
+
+MAGIC = b'SCLUSTST'
+VERSION = 2
+ALIGN = 64
+_PREAMBLE = struct.Struct('<8sIQ')
+
+
+def _pad(n):
+    return (ALIGN - n % ALIGN) % ALIGN
+
+
+def write_arrays(path, arrays, **scalars):
+    """ Write a dict of numpy arrays plus JSON-serializable scalars to path. """
+    header = dict(scalars, version=VERSION, arrays={})
+    offset = 0
+    for name, arr in arrays.items():
+        header['arrays'][name] = [arr.dtype.str, list(arr.shape), offset]
+        offset += arr.nbytes + _pad(arr.nbytes)
+    header = json.dumps(header).encode('utf-8')
+    start = _PREAMBLE.size + len(header)
+    start += _pad(start)
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(_PREAMBLE.pack(MAGIC, VERSION, len(header)))
+        f.write(header)
+        f.write(b'\0' * (start - f.tell()))
+        for arr in arrays.values():
+            f.write(np.ascontiguousarray(arr).tobytes())
+            f.write(b'\0' * _pad(arr.nbytes))
+    # Replace the old snapshot only once the new one is complete.
+    os.replace(tmp, path)
+
+
+def read_arrays(path):
+    """ Return (header, arrays) for a file written by write_arrays. Arrays are
+    read-only memory maps of the file. """
+    with open(path, 'rb') as f:
+        magic, version, header_len = _PREAMBLE.unpack(f.read(_PREAMBLE.size))
+        if magic != MAGIC:
+            raise ValueError('%s is not an sclust state file' % path)
+        if version != VERSION:
+            raise ValueError('%s has state version %d, expected %d' % (path, version, VERSION))
+        header = json.loads(f.read(header_len).decode('utf-8'))
+    start = _PREAMBLE.size + header_len
+    start += _pad(start)
+    arrays = {}
+    for name, (dtype, shape, offset) in header['arrays'].items():
+        if np.prod(shape) == 0:
+            arrays[name] = np.zeros(shape, dtype=dtype)
+        else:
+            arrays[name] = np.memmap(path, dtype=dtype, mode='r', offset=start + offset, shape=tuple(shape))
+    return header, arrays
+
+
+def save_state(path, clusters, index, doc_freqs, docnum, cluster_count, vocab, **scalars):
+    """
+    Write clusters, index, doc_freqs and the vocabulary to path. Terms are
+    stored by their vocabulary id, and clusters in postings by position.
+    For hashed terms (see sclust.hashing), no tokens are stored, and
+    doc_freqs holds the count of every bucket as of line docnum. Any other
+    JSON-serializable scalars are stored too, and returned by load_state.
+    """
+    cluster_pos = {c: i for i, c in enumerate(clusters)}
+    centroids = [c.term_weights for c in clusters]
+    postings = [(t, [cluster_pos[c] for c in cs]) for t, cs in index.items() if len(cs) > 0]
+    header = {'scalars': scalars}
+    if hasattr(vocab, 'buckets'):
+        freqs = doc_freqs.counts / doc_freqs.scale(docnum)
+        header['hash_buckets'] = vocab.buckets
+    else:
+        freqs = np.zeros(len(vocab.tokens), dtype=np.int64)
+        freqs[list(doc_freqs.keys())] = list(doc_freqs.values())
+    arrays = {
+        'terms': np.frombuffer('\n'.join(vocab.tokens).encode('utf-8'), dtype=np.uint8),
+        'doc_freqs': freqs,
+        'cluster_ids': np.array([c._id for c in clusters], dtype=np.int64),
+        'cluster_sizes': np.array([c.size for c in clusters], dtype=np.int64),
+        'cluster_created': np.array([c.created for c in clusters], dtype=np.int64),
+        'cluster_updated': np.array([c.updated for c in clusters], dtype=np.int64),
+        'cluster_totals': np.array([c.total_tokens for c in clusters], dtype=np.float64),
+        'centroid_indptr': np.cumsum([0] + [len(ws) for ws in centroids], dtype=np.int64),
+        'centroid_terms': np.array([t for ws in centroids for t in ws], dtype=np.int64),
+        'centroid_weights': np.array([w for ws in centroids for w in ws.values()], dtype=np.float64),
+        'index_terms': np.array([t for t, _ in postings], dtype=np.int64),
+        'index_indptr': np.cumsum([0] + [len(cs) for _, cs in postings], dtype=np.int64),
+        'index_clusters': np.array([c for _, cs in postings for c in cs], dtype=np.int64),
+    }
+    write_arrays(path, arrays, docnum=docnum, cluster_count=cluster_count, nterms=len(vocab.tokens), **header)
+
+
+def load_state(path, scorer):
+    """
+    Read a file written by save_state, rebuilding the clusters with scorer.
+    Returns (clusters, index, doc_freqs, docnum, cluster_count, vocab, scalars).
+    """
+    from .sclust import Vocabulary
+    from .hashing import BucketCounts, HashedVocabulary
+    header, a = read_arrays(path)
+    freqs = a['doc_freqs']
+    if 'hash_buckets' in header:
+        vocab = HashedVocabulary(header['hash_buckets'])
+        doc_freqs = BucketCounts(header['hash_buckets'])
+        doc_freqs.counts[:] = freqs
+        doc_freqs.rebuild()
+        doc_freqs.origin = header['docnum']
+    else:
+        tokens = bytes(a['terms']).decode('utf-8').split('\n') if header['nterms'] > 0 else []
+        vocab = Vocabulary(tokens)
+        doc_freqs = Counter(dict(zip(np.flatnonzero(freqs).tolist(), freqs[freqs > 0].tolist())))
+    indptr = a['centroid_indptr'].tolist()
+    cterms = a['centroid_terms'].tolist()
+    cweights = a['centroid_weights'].tolist()
+    created = a['cluster_created'].tolist()
+    updated = a['cluster_updated'].tolist()
+    clusters = []
+    for i, (_id, size, total) in enumerate(zip(a['cluster_ids'].tolist(), a['cluster_sizes'].tolist(),
+                                               a['cluster_totals'].tolist())):
+        term_weights = dict(zip(cterms[indptr[i]:indptr[i + 1]], cweights[indptr[i]:indptr[i + 1]]))
+        clusters.append(scorer.restore(_id, size, total, term_weights))
+        clusters[-1].created = created[i]
+        clusters[-1].updated = updated[i]
+    index = defaultdict(set)
+    indptr = a['index_indptr'].tolist()
+    iclusters = a['index_clusters'].tolist()
+    for i, t in enumerate(a['index_terms'].tolist()):
+        postings = index[t]
+        for c in iclusters[indptr[i]:indptr[i + 1]]:
+            postings.add(clusters[c])
+            clusters[c].terms.append(t)
+    return clusters, index, doc_freqs, header['docnum'], header['cluster_count'], vocab, header.get('scalars', {})
+
+
+def save_idf_table(path, doc_freqs, docnum, source=None):
+    """
+    Write doc_freqs, the document frequencies of terms (strings) over docnum
+    lines, to path, so the idfs of a corpus can be reused. source is a
+    JSON-serializable description of what was counted, checked on loading.
+
+    >>> import tempfile
+    >>> path = os.path.join(tempfile.mkdtemp(), 'idf')
+    >>> save_idf_table(path, Counter({'sing': 2, 'hi': 1}), 5, {'size': 10})
+    >>> load_idf_table(path, {'size': 10}) == (Counter({'sing': 2, 'hi': 1}), 5)
+    True
+    >>> load_idf_table(path, {'size': 11})  # doctest: +ELLIPSIS
+    Traceback (most recent call last):
+    ...
+    ValueError: ...idf was counted from {"size": 10}, not {"size": 11}
+    """
+    terms = list(doc_freqs)
+    arrays = {
+        'terms': np.frombuffer('\n'.join(terms).encode('utf-8'), dtype=np.uint8),
+        'doc_freqs': np.array([doc_freqs[t] for t in terms], dtype=np.int64),
+    }
+    write_arrays(path, arrays, kind='idf', docnum=docnum, nterms=len(terms), source=source)
+
+
+def load_idf_table(path, source=None):
+    """ Read a file written by save_idf_table. Returns (doc_freqs, docnum).
+    With source, the table must have been saved with the same source. """
+    header, a = read_arrays(path)
+    if header.get('kind') != 'idf':
+        raise ValueError('%s is not an idf table' % path)
+    if source is not None and header.get('source') != source:
+        raise ValueError('%s was counted from %s, not %s' % (
+            path, json.dumps(header.get('source'), sort_keys=True), json.dumps(source, sort_keys=True)))
+    terms = bytes(a['terms']).decode('utf-8').split('\n') if header['nterms'] > 0 else []
+    return Counter(dict(zip(terms, a['doc_freqs'].tolist()))), header['docnum']
@@ -0,0 +1,316 @@
+# -*- coding: utf-8 -*-
+"""Read and write on background threads, so clustering overlaps with I/O.
+
+read_blocks reads a binary stream in large blocks, decodes them and splits
+them into stripped lines. LineReader iterates over such blocks on a thread,
+and queues the list of lines of each block.
+BackgroundStream is a file-like object whose writes and flushes are queued
+and done by a thread. Both queues are bounded: the reader stops reading when
+the clusterer falls behind, and writes block when the output falls behind.
+
+Each side counts the seconds the main thread spent waiting on it: for a
+block to be read, or for room in the output queue. Together with the queue
+depths, these show whether input, output, or clustering is the bottleneck.
+
+open_file opens a file for reading bytes, decompressing gzip, bz2 and xz
+files as they are read. FileReader reads the lines of several files in turn,
+optionally on threads that read and decompress files ahead of the one being
+consumed.
+"""
+from collections import deque
+import codecs
+import importlib
+import io
+import queue
+import sys
+import threading
+import time
+
+# Read at most this many bytes at a time.
+READ_BYTES = 1 << 20
+# Blocks of lines read ahead of the clusterer, per file, before blocking.
+READ_QUEUE = 8
+# Chunks of output queued before blocking.
+WRITE_QUEUE = 64
+
+# Queued by BackgroundStream.flush.
+_FLUSH = object()
+
+# The first bytes of each compressed format, and the module that reads it.
+MAGIC = [(b'\x1f\x8b', 'gzip'), (b'BZh', 'bz2'), (b'\xfd7zXZ\x00', 'lzma')]
+
+
+def compression(head):
+    """
+    Return the name of the module that decompresses a file starting with the
+    bytes head, or None if it is not compressed.
+
+    >>> compression(b'BZh91AY'), compression(b'plain')
+    ('bz2', None)
+    """
+    for prefix, module in MAGIC:
+        if head.startswith(prefix):
+            return module
+    return None
+
+
+def open_file(path, buffer_size=READ_BYTES):
+    """
+    Open the file at path, or stdin if path is -, for reading bytes with a
+    buffer of buffer_size bytes. Files starting with the magic bytes of gzip,
+    bz2 or xz are decompressed as they are read. Closing the returned stream
+    closes the file.
+    """
+    if path == '-':
+        return getattr(sys.stdin, 'buffer', sys.stdin)
+    f = open(path, 'rb', buffering=buffer_size)
+    module = compression(f.peek(len(MAGIC[-1][0])))
+    if module is None:
+        return f
+    f.close()
+    # Opened by path, so that the decompressor owns and closes the file.
+    return io.BufferedReader(importlib.import_module(module).open(path), buffer_size)
+
+
+def read_blocks(stream, encoding='utf-8', errors='strict', block_size=READ_BYTES):
+    """
+    Yield the stripped lines of a binary stream as a list per block of up to
+    block_size bytes. Lines end at \\n, \\r\\n or \\r, as for a text file.
+    A text stream is read without decoding.
+
+    >>> import io
+    >>> list(read_blocks(io.BytesIO(b' a \\r\\nb\\rc\\n\\nd'), block_size=3))
+    [['a'], ['b', 'c'], [''], ['d']]
+    """
+    decoder = codecs.getincrementaldecoder(encoding)(errors)
+    # read1 returns what is available, so lines are not held back waiting
+    # for a full block from a slow pipe.
+    read = getattr(stream, 'read1', stream.read)
+    rest = ''
+    while True:
+        data = read(block_size)
+        text = rest + (data if isinstance(data, str) else decoder.decode(data, len(data) == 0))
+        if len(data) == 0:
+            if text:
+                yield split_lines(text)
+            return
+        # Keep the last, possibly partial, line and a trailing \r that may
+        # start a \r\n for the next block.
+        end = max(text.rfind('\n'), text.rfind('\r', 0, len(text) - 1)) + 1
+        rest = text[end:]
+        if end > 0:
+            yield split_lines(text[:end])
+
+
+def split_lines(text):
+    lines = text.replace('\r\n', '\n').replace('\r', '\n').split('\n')
+    if lines[-1] == '':
+        lines.pop()  # text ended with a newline
+    return [line.strip() for line in lines]
+
+
+class LineReader:
+    """
+    Iterate over blocks, an iterator over lists of lines such as read_blocks,
+    read ahead on a thread.
+
+    >>> import io
+    >>> list(LineReader(read_blocks(io.BytesIO(b'a\\nb'), block_size=2)))
+    [['a'], ['b']]
+    """
+    def __init__(self, blocks, queue_size=READ_QUEUE):
+        self.blocks = blocks
+        self.queue = queue.Queue(queue_size)
+        self.wait_sec = 0.
+        self.thread = threading.Thread(target=self.read)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def read(self):
+        """ Queue each block, then None, or the exception that stopped reading. """
+        try:
+            for block in self.blocks:
+                self.queue.put(block)
+            self.queue.put(None)
+        except Exception as e:
+            self.queue.put(e)
+
+    def __iter__(self):
+        q = self.queue
+        while True:
+            try:
+                block = q.get_nowait()
+            except queue.Empty:
+                start = time.perf_counter()
+                block = q.get()
+                self.wait_sec += time.perf_counter() - start
+            if block is None:
+                return
+            if isinstance(block, Exception):
+                raise block
+            yield block
+
+    def stats(self):
+        return {'read_queue': self.queue.qsize(), 'read_wait_sec': self.wait_sec}
+
+
+class BackgroundStream:
+    """
+    A file-like object that writes to stream on a thread. An error from
+    stream is raised by the next call after it.
+
+    >>> import io
+    >>> s = io.StringIO()
+    >>> out = BackgroundStream(s)
+    >>> out.write('a\\n')
+    >>> out.close()
+    >>> s.getvalue()
+    'a\\n'
+    """
+    def __init__(self, stream, queue_size=WRITE_QUEUE):
+        self.stream = stream
+        self.queue = queue.Queue(queue_size)
+        self.wait_sec = 0.
+        self.error = None
+        self.thread = threading.Thread(target=self.drain)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def drain(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    if self.error is None:
+                        self.stream.flush()
+                    return
+                if self.error is not None:
+                    continue  # discard output after an error, so put never blocks
+                if item is _FLUSH:
+                    self.stream.flush()
+                else:
+                    self.stream.write(item)
+            except Exception as e:
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def put(self, item):
+        if self.error is not None:
+            raise self.error
+        try:
+            self.queue.put_nowait(item)
+        except queue.Full:
+            start = time.perf_counter()
+            self.queue.put(item)
+            self.wait_sec += time.perf_counter() - start
+
+    def write(self, data):
+        self.put(data)
+
+    def flush(self):
+        """ Queue a flush of stream; see wait to wait for it. """
+        self.put(_FLUSH)
+
+    def wait(self):
+        """ Wait until everything queued has been written. """
+        self.queue.join()
+        if self.error is not None:
+            raise self.error
+
+    def close(self):
+        self.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+    def stats(self):
+        return {'write_queue': self.queue.qsize(), 'write_wait_sec': self.wait_sec}
+
+
+def read_file(path):
+    """ Yield the blocks of read_blocks for the file at path, decoded as
+    UTF-8, or stdin's encoding for stdin, and close the file once read. """
+    stream = open_file(path)
+    encoding, errors = 'utf-8', 'replace'
+    if path == '-':
+        encoding = getattr(sys.stdin, 'encoding', None) or encoding
+        errors = getattr(sys.stdin, 'errors', None) or 'strict'
+    try:
+        for block in read_blocks(stream, encoding, errors):
+            yield block
+    finally:
+        if path != '-':
+            stream.close()
+
+
+class FileReader:
+    """
+    Iterate over the stripped lines of the files at paths in turn (- for
+    stdin), decoded as UTF-8, or stdin's encoding for stdin.
+
+    With threads, each file is read by a LineReader, and up to ahead files
+    after the current one are opened and read into their queues while it is
+    consumed, so decompression runs ahead of clustering.
+
+    >>> import os, tempfile, gzip
+    >>> path = os.path.join(tempfile.mkdtemp(), 'a.gz')
+    >>> with gzip.open(path, 'wb') as f:
+    ...     _ = f.write(b'x y\\nz\\n')
+    >>> list(FileReader([path, path]))
+    ['x y', 'z', 'x y', 'z']
+    >>> list(FileReader([path], threads=True).positions())  # doctest: +ELLIPSIS
+    [('...a.gz:1', 'x y'), ('...a.gz:2', 'z')]
+    """
+    def __init__(self, paths, threads=False, ahead=1):
+        self.paths = list(paths)
+        self.threads = threads
+        self.ahead = ahead
+        self.readers = deque()
+        self.wait_sec = 0.
+
+    def open(self, path):
+        """ Return an iterator over the blocks of lines of the file at path. """
+        if self.threads:
+            reader = LineReader(read_file(path))
+            self.readers.append(reader)
+            return iter(reader)
+        return read_file(path)
+
+    def files(self):
+        """ Yield (path, iterator over blocks of lines) for each file,
+        opening threaded readers up to ahead files early. """
+        opened = deque()
+        paths = iter(self.paths)
+        for path in paths:
+            opened.append((path, self.open(path)))
+            if not self.threads or len(opened) > self.ahead:
+                yield opened.popleft()
+        while opened:
+            yield opened.popleft()
+
+    def __iter__(self):
+        for path, blocks in self.files():
+            for block in blocks:
+                for line in block:
+                    yield line
+            self.done()
+
+    def positions(self):
+        """ Yield (path:line number, line) for each line. """
+        for path, blocks in self.files():
+            lineno = 0
+            for block in blocks:
+                for line in block:
+                    lineno += 1
+                    yield '%s:%d' % (path, lineno), line
+            self.done()
+
+    def done(self):
+        """ Forget the reader of a file read to the end. """
+        if self.readers:
+            self.wait_sec += self.readers.popleft().wait_sec
+
+    def stats(self):
+        return {'read_queue': sum(r.queue.qsize() for r in self.readers),
+                'read_wait_sec': self.wait_sec + sum(r.wait_sec for r in self.readers)}
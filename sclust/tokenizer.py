@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+"""Split lines into tokens.
+
+A Tokenizer lowercases a line, replaces anything matched by its normalizers
+with a placeholder token, and returns the matches of its token pattern that
+are not stopwords. The default Tokenizer splits on runs of word characters,
+as sclust always has.
+
+Normalizers, applied in this order:
+    url       web addresses (http://..., https://..., www....) -> webaddress
+    mention   @mentions -> usermention
+    number    numbers, including 1,000 and 3.14 -> number
+
+tokenize_many lowercases and normalizes a batch of lines in one pass over
+their concatenation, which is faster than doing so line by line.
+"""
+from collections import OrderedDict
+import re
+
+PATTERN = r'\w+'
+
+NORMALIZERS = OrderedDict([
+    ('url', (r'(?:https?://|www\.)\S+', ' webaddress ')),
+    ('mention', (r'@\w+', ' usermention ')),
+    ('number', (r'\b\d+(?:[.,]\d+)*\b', ' number ')),
+])
+
+STOPWORDS = {
+    'english': frozenset("""
+        a about above after again against all am an and any are as at be because been before being below
+        between both but by can could did do does doing down during each few for from further had has have
+        having he her here hers herself him himself his how i if in into is it its itself just me more most
+        my myself no nor not now of off on once only or other our ours ourselves out over own same she
+        should so some such than that the their theirs them themselves then there these they this those
+        through to too under until up very was we were what when where which while who whom why will with
+        would you your yours yourself yourselves
+        """.split()),
+}
+
+
+class Tokenizer:
+    """
+    >>> tokenize = Tokenizer()
+    >>> tokenize('Hi there, how are you?')
+    ['hi', 'there', 'how', 'are', 'you']
+    >>> tokenize = Tokenizer(normalizers=['url', 'mention', 'number'], stopwords='english')
+    >>> tokenize('@Bob see http://t.co/x1 at 10:30, 2 times')
+    ['usermention', 'see', 'webaddress', 'number', 'number', 'number', 'times']
+    >>> tokenize.tokenize_many(['A cat', 'the 2 dogs'])
+    [['cat'], ['number', 'dogs']]
+    """
+    def __init__(self, pattern=PATTERN, normalizers=(), stopwords=()):
+        for name in normalizers:
+            if name not in NORMALIZERS:
+                raise ValueError('unknown normalizer %s' % name)
+        self.pattern = pattern
+        self.normalizers = [name for name in NORMALIZERS if name in normalizers]
+        self.stopwords = STOPWORDS[stopwords] if isinstance(stopwords, str) else frozenset(stopwords)
+        self._findall = re.compile(pattern).findall
+        self._subs = [(re.compile(NORMALIZERS[name][0]).sub, NORMALIZERS[name][1]) for name in self.normalizers]
+
+    def normalize(self, text):
+        """ Return text lowercased, with normalizer matches replaced. """
+        text = text.lower()
+        for sub, placeholder in self._subs:
+            text = sub(placeholder, text)
+        return text
+
+    def tokenize(self, line):
+        """ Return the list of tokens of line. """
+        tokens = self._findall(self.normalize(line))
+        if self.stopwords:
+            stopwords = self.stopwords
+            tokens = [t for t in tokens if t not in stopwords]
+        return tokens
+
+    __call__ = tokenize
+
+    def tokenize_many(self, lines):
+        """ Return the list of tokens of each of lines. """
+        text = self.normalize('\n'.join(lines))
+        parts = text.split('\n')
+        if len(parts) != len(lines):
+            # Some line has a newline of its own.
+            return [self.tokenize(line) for line in lines]
+        findall, stopwords = self._findall, self.stopwords
+        if stopwords:
+            return [[t for t in findall(part) if t not in stopwords] for part in parts]
+        return [findall(part) for part in parts]
+
+    def config(self):
+        """ Return the settings of this tokenizer as JSON-serializable values.
+
+        >>> Tokenizer(normalizers=['number'], stopwords=['b', 'a']).config()
+        {'pattern': '\\\\w+', 'normalizers': ['number'], 'stopwords': ['a', 'b']}
+        """
+        return {'pattern': self.pattern, 'normalizers': list(self.normalizers),
+                'stopwords': sorted(self.stopwords)}
+
+    def __getstate__(self):
+        return self.pattern, self.normalizers, self.stopwords
+
+    def __setstate__(self, state):
+        self.__init__(*state)
+
+
+def build_tokenizer(pattern=PATTERN, normalize=None, stopwords=None):
+    """ Return a Tokenizer for command-line options: normalize is a
+    comma-separated list of NORMALIZERS, and stopwords the name of a list in
+    STOPWORDS or a file with one stopword per line. """
+    normalizers = normalize.split(',') if normalize else ()
+    if stopwords and stopwords not in STOPWORDS:
+        with open(stopwords) as f:
+            stopwords = [line.strip().lower() for line in f if line.strip()]
+    return Tokenizer(pattern, normalizers, stopwords or ())
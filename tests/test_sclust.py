@@ -8,9 +8,40 @@ test_sclust
 Tests for `sclust` module.
 """
 
+import io
+import json
+import os
+import sys
+import tempfile
 import unittest
 
 from sclust import sclust
+from sclust import sclust_summarize
+
+
+LINES = [
+    'Hi there, how are you?',
+    'hi where how you are',
+    'i like to sing',
+    'I am going to sing',
+    'hi where how you are',
+    'hi there how...',
+    'do you sing???',
+]
+
+
+def run_sclust(lines, **kwargs):
+    """ Run sclust.run over lines and return its output lines. """
+    args = dict(threshold=.2, prune_freq=-1, min_match=2, term_filter=5)
+    args.update(kwargs)
+    stdin, stdout = sys.stdin, sys.stdout
+    sys.stdin = io.StringIO('\n'.join(lines) + '\n')
+    sys.stdout = io.StringIO()
+    try:
+        sclust.run(**args)
+        return sys.stdout.getvalue().splitlines()
+    finally:
+        sys.stdin, sys.stdout = stdin, stdout
 
 
 class TestSclust(unittest.TestCase):
@@ -24,7 +55,423 @@ class TestSclust(unittest.TestCase):
     def test_000_something(self):
         pass
 
+    def test_readme_example(self):
+        out = run_sclust(LINES)
+        self.assertEqual([l.split('\t')[0] for l in out],
+                         ['0', '1', '2', '2', '1', '0', '3'])
+        self.assertEqual(out[3], '2\tI am going to sing\t0.298455')
+
+    def test_clusterer_matches_cli(self):
+        lines = LINES * 3
+        clusterer = sclust.Clusterer(prune_freq=5)
+        results = list(clusterer.assign_many(lines, batch_size=2))
+        out = run_sclust(lines, prune_freq=5, batch_size=2)
+        self.assertEqual(['%d\t%s\t%s' % (c, line.strip(), '-' if s is None else '%g' % s)
+                          for line, (c, s) in zip(lines, results)], out)
+        self.assertEqual(clusterer.stats()['lines'], len(lines))
+        self.assertEqual(len(clusterer.clusters), clusterer.stats()['clusters'])
+
+    def test_stats_file(self):
+        path = os.path.join(tempfile.mkdtemp(), 'stats.jsonl')
+        out = run_sclust(LINES * 2, stats_every=7, stats_file=path)
+        self.assertEqual(out, run_sclust(LINES * 2))
+        with open(path) as f:
+            reports = [json.loads(line) for line in f]
+        self.assertEqual([r['lines'] for r in reports], [7, 14])
+        self.assertEqual(reports[0]['new_cluster_fraction'], 4. / 7)
+        self.assertEqual(reports[1]['clusters'], 4)
+
+    def test_numpy_engine_matches_dict(self):
+        lines = LINES * 20
+        self.assertEqual(run_sclust(lines, engine='numpy', prune_freq=10),
+                         run_sclust(lines, engine='dict', prune_freq=10))
+
+    def test_maxscore_retrieval(self):
+        lines = LINES * 20
+        for min_match in (1, 2, 3):
+            self.assertEqual(run_sclust(lines, retrieval='maxscore', min_match=min_match),
+                             run_sclust(lines, min_match=min_match))
+        from collections import defaultdict
+        index = defaultdict(set)
+        clusters = [sclust.Cluster(i, {1: 1, 2: 1}) for i in range(5)]
+        for c in clusters:
+            c.size = c._id + 1
+            sclust.update_index(index, c, [1, 2])
+        top = sclust.TopPostings(2)
+        self.assertEqual(sclust.search_index_pruned(index, [1, 2], 2, top),
+                         [clusters[4], clusters[3]])
+
+    def test_lsh_retrieval(self):
+        lines = LINES * 20
+        out = run_sclust(lines, retrieval='lsh', prune_freq=10)
+        self.assertEqual([l.split('\t')[1] for l in out], [l.strip() for l in lines])
+        self.assertEqual(out, run_sclust(lines, retrieval='lsh', prune_freq=10, engine='numpy'))
+        path = os.path.join(tempfile.mkdtemp(), 'state')
+        first = run_sclust(lines[:37], retrieval='lsh', prune_freq=10, save_state=path)
+        rest = run_sclust(lines[37:], retrieval='lsh', prune_freq=10, load_state=path)
+        self.assertEqual(len(first + rest), len(lines))
+        c = sclust.Clusterer(retrieval='lsh', prune_freq=10)
+        list(c.assign_many(lines))
+        self.assertEqual(set(c.scorer.signatures), set(c.clusters))
+
+    def test_max_terms(self):
+        lines = LINES * 3
+        clusterer = sclust.Clusterer(max_terms=2)
+        results = list(clusterer.assign_many(lines))
+        self.assertTrue(all(len(c.terms) <= 2 and len(c.term_weights) <= 2 for c in clusterer.clusters))
+        self.assertEqual(run_sclust(lines, max_terms=2), run_sclust(lines, max_terms=2, engine='numpy'))
+        self.assertEqual([l.split('\t')[0] for l in run_sclust(lines, max_terms=2)],
+                         [str(c) for c, _ in results])
+
+    def test_consolidate(self):
+        lines = LINES * 5
+        remaps = os.path.join(tempfile.mkdtemp(), 'remaps')
+        out = run_sclust(lines, consolidate_every=7, merge_threshold=.1, remap_file=remaps)
+        self.assertEqual([l.split('\t')[1] for l in out], [l.strip() for l in lines])
+        with open(remaps) as f:
+            merges = [[int(x) for x in l.split('\t')] for l in f]
+        self.assertTrue(len(merges) > 0)
+        ids = [int(l.split('\t')[0]) for l in out]
+        for lineno, old, new in merges:
+            self.assertNotIn(old, ids[lineno:])
+        self.assertEqual(run_sclust(lines, consolidate_every=7, merge_threshold=.1, remap_file=remaps,
+                                    engine='numpy'), out)
+        # Resuming from a snapshot consolidates as the uninterrupted run does.
+        path = os.path.join(tempfile.mkdtemp(), 'state')
+        opts = dict(consolidate_every=5, consolidate_clusters=2, merge_threshold=.1, remap_file=remaps)
+        out = run_sclust(lines, **opts)
+        first = run_sclust(lines[:6], save_state=path, **opts)
+        self.assertEqual(first + run_sclust(lines[6:], load_state=path, **opts), out)
+
+    def test_hash_buckets(self):
+        lines = LINES * 3
+        out = run_sclust(lines, hash_buckets=1 << 20)
+        self.assertEqual(out, run_sclust(lines))
+        decayed = run_sclust(lines, hash_buckets=1 << 20, df_half_life=5)
+        self.assertEqual([l.split('\t')[1] for l in decayed], [l.strip() for l in lines])
+        path = os.path.join(tempfile.mkdtemp(), 'state')
+        first = run_sclust(lines[:17], hash_buckets=1 << 20, save_state=path)
+        self.assertEqual(first + run_sclust(lines[17:], hash_buckets=1 << 20, load_state=path), out)
+        with self.assertRaises(ValueError):
+            run_sclust(lines[17:], hash_buckets=1 << 10, load_state=path)
+
+    def test_tokenizer(self):
+        from sclust.tokenizer import Tokenizer
+        lines = LINES + ['two\nlines']
+        self.assertEqual(sclust.tokenize.tokenize_many(lines), [sclust.tokenize(l) for l in lines])
+        lines = LINES[:2] + ['see http://a.co/x @bob', 'see www.b.com @al now', 'the 10 cats', 'THE 2 CATS']
+        stopwords = os.path.join(tempfile.mkdtemp(), 'stopwords')
+        with open(stopwords, 'w') as f:
+            f.write('the\nnow\n')
+        out = run_sclust(lines, normalize='url,mention,number', stopwords=stopwords, min_match=1)
+        self.assertEqual([int(l.split('\t')[0]) for l in out], [0, 1, 2, 2, 3, 3])
+        self.assertEqual(run_sclust(lines, normalize='url,mention,number', stopwords=stopwords,
+                                    min_match=1, workers=2), out)
+        c = sclust.Clusterer(min_match=1, tokenizer=Tokenizer(normalizers=['url', 'mention', 'number'],
+                                                              stopwords=['the', 'now']))
+        self.assertEqual([r[0] for r in c.assign_many(lines)], [0, 1, 2, 2, 3, 3])
+        with self.assertRaises(ValueError):
+            Tokenizer(normalizers=['emoji'])
+
+    def test_duplicate_cache(self):
+        lines = LINES * 20
+        c = sclust.Clusterer(duplicate_cache=100, prune_freq=10)
+        results = list(c.assign_many(lines))
+        self.assertEqual(results[:len(LINES)], list(sclust.Clusterer().assign_many(LINES)))
+        self.assertGreater(c.counters['duplicates'], len(lines) // 2)
+        c.clusters, c.index = sclust.prune_clusters(c.clusters, c.index, n=1000, scorer=c.scorer)
+        self.assertEqual(c.assign(LINES[0]), (c.cluster_count - 1, None))
+
+    def test_nearest(self):
+        # nearest answers as the assign of the same line would.
+        lines = LINES + ['sing sing sing la la', 'hi hi there zebra', 'how are you doing, friend?'] + LINES
+        for opts in ({}, {'hash_buckets': 1 << 20}, {'duplicate_cache': 100}, {'retrieval': 'maxscore'},
+                     {'term_filter': 2, 'min_match': 1}):
+            c = sclust.Clusterer(**opts)
+            for line in lines:
+                found = c.nearest(line)
+                cluster, score = c.assign(line)
+                if score is None:
+                    self.assertEqual(found, (None, None))
+                else:
+                    self.assertEqual(found[0], cluster)
+                    self.assertAlmostEqual(found[1], score)
+        self.assertIsNone(c.nearest('...'))
+
+    def test_workers(self):
+        lines = LINES * 10
+        out = run_sclust(lines, workers=2, exchange_every=7)
+        self.assertEqual([l.split('\t')[1] for l in out], [l.strip() for l in lines])
+        self.assertEqual(out, run_sclust(lines, workers=2, exchange_every=7))
+        ids = [int(l.split('\t')[0]) for l in out]
+        self.assertEqual(sorted(set(ids)), list(range(len(set(ids)))))
+        out = run_sclust(lines, workers=2, exchange_every=7, max_clusters=2)
+        self.assertEqual([l.split('\t')[1] for l in out], [l.strip() for l in lines])
+        # Each shard hears of the term counts of the other shards' lines.
+        import multiprocessing
+        from collections import Counter
+        from sclust.parallel import dispatch
+        pipes = [multiprocessing.Pipe() for _ in range(2)]
+        lines = ['sing sing la', 'hi hi hi there', 'you are you']
+        pending = [(Counter(), 0) for _ in pipes]
+        _, _, shards = dispatch(lines, [conn for conn, _ in pipes], Counter(), pending)
+        for s, (freqs, nlines) in enumerate(pending):
+            others = [i for i in range(len(lines)) if i not in shards[s]]
+            self.assertEqual(freqs, Counter(t for i in others for t in sclust.tokenize(lines[i])))
+            self.assertEqual(nlines, len(others))
+
+    def test_worker_removed(self):
+        import multiprocessing
+        from collections import Counter
+        from sclust.parallel import worker
+        conn, child = multiprocessing.Pipe()
+        conn.send((LINES, Counter(), 0))
+        conn.send(None)
+        worker(child, {'max_clusters': 2}, 1)
+        results, removed = conn.recv()
+        created = {r[0] for r in results if r is not None and r[1] is None}
+        self.assertGreater(len(removed), 0)
+        self.assertLessEqual(len(created) - len(removed), 2)
+        self.assertTrue(set(removed) <= created)
+
+    def test_server(self):
+        import asyncio
+        import socket
+        import threading
+        from sclust.server import Server
+        tmpdir = tempfile.mkdtemp()
+        path = os.path.join(tmpdir, 'sclust.sock')
+        server = Server(sclust.Clusterer(), batch_size=4, save_state=os.path.join(tmpdir, 'state'))
+        loop = asyncio.new_event_loop()
+        thread = threading.Thread(target=loop.run_until_complete, args=(server.serve('unix:' + path),))
+        thread.start()
+        while not os.path.exists(path):
+            thread.join(.01)
+        # Bad requests first: the good ones after them must still be answered.
+        requests = [[1, 2], {'op': 'assign', 'text': 5}]
+        requests += [{'op': 'assign', 'text': l} for l in LINES]
+        requests += [{'op': 'query', 'text': LINES[3], 'id': 'q'}, {'op': 'stats'}, {'op': 'nope'}]
+        sock = socket.socket(socket.AF_UNIX)
+        sock.connect(path)
+        f = sock.makefile('rw')
+        f.write(''.join(json.dumps(r) + '\n' for r in requests))
+        f.flush()
+        responses = [json.loads(f.readline()) for _ in requests]
+        sock.close()
+        loop.call_soon_threadsafe(server.shutdown)
+        thread.join()
+        loop.close()
+        self.assertIn('error', responses[0])
+        self.assertIn('error', responses[1])
+        responses = responses[2:]
+        expected = [l.split('\t') for l in run_sclust(LINES, batch_size=4)]
+        self.assertEqual([str(r['cluster']) for r in responses[:len(LINES)]], [e[0] for e in expected])
+        self.assertEqual(responses[len(LINES)]['id'], 'q')
+        self.assertEqual(responses[len(LINES)]['cluster'], int(expected[3][0]))
+        self.assertEqual(responses[len(LINES) + 1]['lines'], len(LINES))
+        self.assertIn('error', responses[-1])
+        self.assertTrue(os.path.exists(os.path.join(tmpdir, 'state')))
+        with self.assertRaises(ValueError):
+            run_sclust([], serve='unix:' + path, workers=2)
+
+    def test_server_op_error(self):
+        import asyncio
+        from sclust.server import Server
+        server = Server(sclust.Clusterer())
+        server.clusterer.nearest = lambda text: 1 / 0
+        loop = asyncio.new_event_loop()
+        batch = [({'op': 'query', 'text': 'a'}, loop.create_future()),
+                 ({'op': 'assign', 'text': LINES[0]}, loop.create_future())]
+        server.process(batch)
+        self.assertIn('ZeroDivisionError', batch[0][1].result()['error'])
+        self.assertEqual(batch[1][1].result()['cluster'], 0)
+        loop.close()
+
+    def test_flush_interval(self):
+        import time
+        from sclust.output import Writer
+        s = io.StringIO()
+        w = Writer('50ms', s)
+        w.write('a\n')
+        self.assertEqual(s.getvalue(), '')
+        # Flushed by the timer, with no further records.
+        time.sleep(.3)
+        self.assertEqual(s.getvalue(), 'a\n')
+        w.write('b\n')
+        w.close()
+        self.assertEqual(s.getvalue(), 'a\nb\n')
+
+    def test_offline(self):
+        lines = LINES * 5
+        tmpdir = tempfile.mkdtemp()
+        path = os.path.join(tmpdir, 'lines.txt')
+        with open(path, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        table = os.path.join(tmpdir, 'idf')
+        out = run_sclust([], offline=path, idf_table=table)
+        self.assertEqual([l.split('\t')[1] for l in out], [l.strip() for l in lines])
+        self.assertTrue(os.path.exists(table))
+        # The second run reads the saved idf table.
+        self.assertEqual(run_sclust([], offline=path, idf_table=table), out)
+        # But not one counted with other tokenizer settings or another file.
+        with self.assertRaises(ValueError):
+            run_sclust([], offline=path, idf_table=table, normalize='number')
+        other = os.path.join(tmpdir, 'other.txt')
+        with open(other, 'w') as f:
+            f.write('one line\n')
+        with self.assertRaises(ValueError):
+            run_sclust([], offline=other, idf_table=table)
+        import gzip
+        with gzip.open(other, 'wb') as f:
+            f.write(b'one line\n')
+        with self.assertRaises(ValueError):
+            run_sclust([], offline=other)
+        for opts in ({'io_threads': True}, {'offsets': True}):
+            with self.assertRaises(ValueError):
+                run_sclust([], offline=path, **opts)
+        reassigned = run_sclust([], offline=path, reassign=True)
+        self.assertEqual([l.split('\t')[1] for l in reassigned], [l.strip() for l in lines])
+        self.assertEqual(run_sclust([], offline=path, reassign=True, workers=2), reassigned)
+        state = os.path.join(tmpdir, 'state')
+        self.assertEqual(run_sclust([], offline=path, hash_buckets=1 << 20, save_state=state),
+                         run_sclust([], offline=path))
+        self.assertEqual(len(run_sclust(LINES, hash_buckets=1 << 20, load_state=state)), len(LINES))
+
+    def test_batch_size(self):
+        lines = LINES * 3
+        out = run_sclust(lines, batch_size=4)
+        self.assertEqual([l.split('\t')[1] for l in out], [l.strip() for l in lines])
+        self.assertEqual(run_sclust(lines, batch_size=1), run_sclust(lines))
+        self.assertEqual(out, run_sclust(lines, batch_size=4, engine='numpy'))
+        c = sclust.Clusterer()
+        list(c.assign_many(lines, 4))
+        self.assertEqual(c.stats()['postings'], sum(len(p) for p in c.index.values()))
+        for batch_size in (0, -1):
+            with self.assertRaises(ValueError):
+                run_sclust(lines, batch_size=batch_size)
+            with self.assertRaises(ValueError):
+                next(c.assign_many(lines, batch_size))
+
+    def test_io_threads(self):
+        lines = LINES * 5
+        self.assertEqual(run_sclust(lines, io_threads=True), run_sclust(lines))
+        self.assertEqual(run_sclust(lines, io_threads=True, batch_size=4, fmt='json'),
+                         run_sclust(lines, batch_size=4, fmt='json'))
+
+    def test_input_files(self):
+        import bz2
+        import gzip
+        lines = LINES * 5
+        tmpdir = tempfile.mkdtemp()
+        paths = [os.path.join(tmpdir, 'a.gz'), os.path.join(tmpdir, 'b.bz2'), os.path.join(tmpdir, 'c.txt')]
+        for path, module, part in zip(paths, [gzip, bz2, io], [lines[:10], lines[10:20], lines[20:]]):
+            with (module.open(path, 'wt') if module is not io else open(path, 'w')) as f:
+                f.write('\n'.join(part) + '\n')
+        expected = run_sclust(lines)
+        self.assertEqual(run_sclust([], files=paths), expected)
+        self.assertEqual(run_sclust([], files=paths, io_threads=True, read_ahead=2, batch_size=4),
+                         run_sclust(lines, batch_size=4))
+        self.assertEqual(run_sclust(lines[:10], files=['-'] + paths[1:]), expected)
+        refs = [l.split('\t')[1] for l in run_sclust([], files=paths, offsets=True)]
+        self.assertEqual(refs[:2], [paths[0] + ':1', paths[0] + ':2'])
+        self.assertIn(paths[1] + ':1', refs)
+        clustered = os.path.join(tmpdir, 'clustered.gz')
+        with gzip.open(clustered, 'wt') as f:
+            f.write('\n'.join(expected) + '\n')
+        self.assertEqual(self.summarize([], 10, 2, 3, files=[clustered]), self.summarize(expected, 10, 2, 3))
+
+    def test_prune_clusters(self):
+        from collections import Counter, defaultdict
+        index = defaultdict(set)
+        clusters = []
+        vocab = sclust.Vocabulary()
+        ta, tb, tc = vocab.intern(['a', 'b', 'c'])
+        for i, line in enumerate(['a b', 'a c', 'b c']):
+            c = sclust.Cluster(i, Counter(vocab.intern(sclust.tokenize(line))))
+            c.size = i + 1
+            clusters.append(c)
+            sclust.update_index(index, c, c.term_scores)
+        clusters, index = sclust.prune_clusters(clusters, index, n=2)
+        self.assertEqual([c._id for c in clusters], [1, 2])
+        self.assertEqual(dict(index), {ta: set(clusters[:1]), tb: set(clusters[1:]),
+                                       tc: set(clusters)})
+        self.assertEqual(sclust.prune_step(clusters, index, 0, 1, n=3), 0)
+        self.assertEqual([c._id for c in clusters], [2])
+        self.assertEqual(dict(index), {tb: set(clusters), tc: set(clusters)})
+        self.assertEqual(sclust.prune_step(clusters, index, 0, 5, n=3, created_before=0), 1)
+
+    def test_evict_clusters(self):
+        from collections import Counter, defaultdict
+
+        def make_clusters():
+            index = defaultdict(set)
+            clusters = []
+            for i, (size, updated) in enumerate([(5, 1), (1, 3), (3, 2)]):
+                c = sclust.Cluster(i, Counter([0, i + 1]))
+                c.size, c.updated = size, updated
+                clusters.append(c)
+                sclust.update_index(index, c, c.term_scores)
+            return clusters, index
+
+        for policy, expected in [('lru', [1, 2]), ('smallest', [0, 2]), ('score', [0, 2])]:
+            clusters, index = make_clusters()
+            kept, _ = sclust.evict_clusters(clusters, index, 1, policy, docnum=10)
+            self.assertEqual([c._id for c in kept], expected)
+        clusters, index = make_clusters()
+        clusters, index = sclust.evict_clusters(clusters, index, 2)
+        self.assertEqual(dict(index), {0: set(clusters), 2: set(clusters)})
+        with self.assertRaises(ValueError):
+            sclust.Clusterer(max_clusters=100, eviction='bogus')
+
+    def test_save_and_load_state(self):
+        lines = LINES * 5
+        expected = run_sclust(lines, prune_freq=10)
+        path = os.path.join(tempfile.mkdtemp(), 'state')
+        for engine in ['dict', 'numpy']:
+            first = run_sclust(lines[:17], prune_freq=10, engine=engine, save_state=path)
+            rest = run_sclust(lines[17:], prune_freq=10, engine=engine, load_state=path)
+            self.assertEqual(first + rest, expected)
+        # The incremental pruning sweep resumes where it stopped.
+        lines = LINES * 10
+        opts = dict(prune_freq=5, prune_incremental=True, min_size=2)
+        first = run_sclust(lines[:9], save_state=path, **opts)
+        self.assertEqual(first + run_sclust(lines[9:], load_state=path, **opts), run_sclust(lines, **opts))
+
+    def summarize(self, lines, *args, **kwargs):
+        stdin, stdout = sys.stdin, sys.stdout
+        sys.stdin, sys.stdout = io.StringIO('\n'.join(lines) + '\n'), io.StringIO()
+        try:
+            sclust_summarize.run(*args, **kwargs)
+            return sys.stdout.getvalue()
+        finally:
+            sys.stdin, sys.stdout = stdin, stdout
+
+    def test_summarize_capacity(self):
+        clustered = run_sclust(LINES * 20)
+        outputs = [self.summarize(clustered, 50, 2, 3, capacity=capacity) for capacity in [-1, 100, 3]]
+        self.assertEqual(outputs[0], outputs[1])
+        headers = lambda out: [l for l in out.split('\n') if l.startswith('---')]
+        self.assertEqual(headers(outputs[0]), headers(outputs[2]))
+
+    def test_formats(self):
+        lines = LINES * 5 + ['tabs\tin\ta line']
+        expected = self.summarize(run_sclust(lines), 10, 2, 3)
+        self.assertEqual(run_sclust(lines, summarize=10, summarize_clusters=2, summarize_docs=3),
+                         expected.splitlines())
+        json_lines = run_sclust(lines, fmt='json')
+        self.assertEqual(json.loads(json_lines[-1])['text'], 'tabs\tin\ta line')
+        summary = json.loads(self.summarize(json_lines, 100, 2, 3, input_format='json',
+                                            output_format='json'))
+        self.assertEqual(summary['documents'], len(lines))
+
+    def test_summarize_recent(self):
+        clustered = ['0\told\t-'] * 10 + ['1\tnew\t-'] + ['1\tnew\t1'] * 4
+        for kwargs in [{'window': 5}, {'half_life': 1.}]:
+            summary = self.summarize(clustered, 100, 2, 1, **kwargs)
+            self.assertIn('1 clusters', summary)
+            self.assertNotIn('old', summary)
+        self.assertIn('old', self.summarize(clustered, 100, 2, 1))
+
 
 if __name__ == '__main__':
-    import sys
     sys.exit(unittest.main())